@@ -7,11 +7,12 @@ import click
 from archctl import __version__
 from archctl.logger import setup_logger
 from archctl.validation import Validation
-from archctl.github import GHCli
+from archctl.github import get_gh_client
 import archctl.utils as util
 import archctl.main as archctl
 import archctl.commons as comm
 import archctl.commands as cmd
+import archctl.git_utils as gu
 
 
 COMMANDS = {
@@ -41,6 +42,16 @@ common_options = [
 
 template_options = [click.argument("template-repo"), click.argument("template")]
 
+clone_options = [
+    click.option(
+        "--clone-strategy",
+        type=click.Choice(list(gu.CLONE_STRATEGIES)),
+        default="shallow",
+        help="How the project repos are cloned, shallow only gets the tip of the branch, "
+        "mirror reuses a local mirror of the registered repos",
+    )
+]
+
 
 def add_options(options):
     def _add_options(func):
@@ -93,7 +104,7 @@ def register(repo, kind, branch, yes, verbose):
 
     repo = comm.get_repo_dataclass(repo)
 
-    cli = GHCli()
+    cli = get_gh_client()
     cli.cw_repo = repo
 
     validator = Validation()
@@ -159,13 +170,14 @@ def delete(repo, yes, verbose):
     type=click.File(mode="r", errors="strict"),
     help="File containing the cookies that will be used when rendering the template",
 )
+@add_options(clone_options)
 @add_options(common_options)
-def create(cookies, name, template_repo, template, verbose, yes):
+def create(cookies, name, template_repo, template, clone_strategy, verbose, yes):
 
     setup_logger(stream_level="DEBUG" if verbose else "INFO")
 
     validator = Validation()
-    cli = GHCli()
+    cli = get_gh_client()
 
     repo = comm.get_repo_dataclass(name)
     t = comm.get_template_version_dataclass(template, template_repo)
@@ -183,31 +195,51 @@ def create(cookies, name, template_repo, template, verbose, yes):
         ][0]
 
     validator.repo_exists_gh(repo, False)
-    validator.template(template)
+    validator.template(t)
     validator.cookies(cookies, yes)
 
     # If running in --yes-all mode, skip any user confirmation
     if not yes:
         validator.confirm_command_execution(
             name=repo.full_name,
-            template=template.template,
-            template_repo=template.template_repo.full_name,
-            template_ref=template.template_version.ref,
+            template=t.template.template,
+            template_repo=t.template.template_repo.full_name,
+            template_ref=t.ref,
         )
 
-    archctl.create(repo, t, yes, cookies)
+    archctl.create(repo, t, yes, cookies, clone_strategy)
 
 
 @main.command()
 @click.argument("repos", nargs=-1, required=True)
 @add_options(template_options)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Max number of repos upgraded concurrently, only with --yes-all",
+)
+@click.option(
+    "--pipeline",
+    is_flag=True,
+    default=False,
+    help="Overlap the stages of the upgrades: one repo renders while others clone or push",
+)
+@click.option(
+    "--cloneless",
+    is_flag=True,
+    default=False,
+    help="Don't clone the repos, read them and commit the changed files through the GitHub API",
+)
+@add_options(clone_options)
 @add_options(common_options)
-def upgrade(repos, template_repo, template, verbose, yes):
+def upgrade(repos, template_repo, template, jobs, pipeline, cloneless, clone_strategy, verbose, yes):
 
     setup_logger(stream_level="DEBUG" if verbose else "INFO")
 
     validator = Validation()
-    cli = GHCli()
+    cli = get_gh_client()
     template_repo = comm.get_repo_dataclass(template_repo)
 
     repos = [
@@ -229,7 +261,7 @@ def upgrade(repos, template_repo, template, verbose, yes):
     if t.ref is None:
         t.ref = cli.get_default_branch()
 
-    validator.template(template)
+    validator.template(t)
 
     # If running in --yes-all mode, skip any user confirmation
     if yes:
@@ -239,12 +271,12 @@ def upgrade(repos, template_repo, template, verbose, yes):
         names = [repo.full_name for repo in repos]
         validator.confirm_command_execution(
             repos=names,
-            template=template.template,
-            template_repo=template.template_repo,
-            template_ref=template.template_version.ref,
+            template=t.template.template,
+            template_repo=t.template.template_repo.full_name,
+            template_ref=t.ref,
         )
 
-    archctl.upgrade(repos, t, yes)
+    archctl.upgrade(repos, t, yes, jobs, pipeline, clone_strategy, cloneless)
 
 
 @main.command()
@@ -262,14 +294,29 @@ def upgrade(repos, template_repo, template, verbose, yes):
     default=False,
     help="Show the diffs for the added files, when not set, it just shows the names of the added files",
 )
+@click.option(
+    "--diff-backend",
+    type=click.Choice(tuple(gu.DIFF_BACKENDS)),
+    default="python",
+    help="Engine that diffs the render, git is much faster on big generated files",
+)
+@click.option(
+    "--stat",
+    is_flag=True,
+    default=False,
+    help="Only show the lines added and deleted in each file, counted by git",
+)
 @add_options(template_options)
+@add_options(clone_options)
 @add_options(common_options)
-def preview(repo, template, template_repo, cookies, show_add, verbose, yes):
+def preview(
+    repo, template, template_repo, cookies, show_add, diff_backend, stat, clone_strategy, verbose, yes
+):
 
     setup_logger(stream_level="DEBUG" if verbose else "INFO")
 
     validator = Validation()
-    cli = GHCli()
+    cli = get_gh_client()
 
     repo = comm.get_repo_dataclass(repo)
     if repo.def_ref is None:
@@ -291,19 +338,19 @@ def preview(repo, template, template_repo, cookies, show_add, verbose, yes):
         ][0]
 
     validator.repo_exists_gh(repo)
-    validator.template(template)
+    validator.template(t)
     # validator.cookies(cookies, yes)
 
     # If running in --yes-all mode, skip any user confirmation
     if not yes:
         validator.confirm_command_execution(
             repos=repo.full_name,
-            template=template.template,
-            template_repo=template.template_repo.full_name,
-            template_ref=template.template_version.ref,
+            template=t.template.template,
+            template_repo=t.template.template_repo.full_name,
+            template_ref=t.ref,
         )
 
-    archctl.preview(repo, t, show_add, yes, cookies)
+    archctl.preview(repo, t, show_add, yes, cookies, clone_strategy, diff_backend, stat)
 
 
 @main.command()
@@ -317,10 +364,50 @@ def preview(repo, template, template_repo, cookies, show_add, verbose, yes):
 )
 @click.option("-t", "--template", help="")
 @click.option("--tags", is_flag=True, default=False, help="")
+@click.option(
+    "-e",
+    "--engine",
+    type=click.Choice(["rest", "graphql"]),
+    default="rest",
+    help="API used to search, graphql batches all the requests in a few queries",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Max number of branches and tags inspected concurrently",
+)
+@click.option(
+    "--local-mirror",
+    is_flag=True,
+    default=False,
+    help="Search a local mirror of the repo, fetched before searching, instead of the API",
+)
+@click.option(
+    "-f",
+    "--format",
+    "output",
+    type=click.Choice(["text", "jsonl"]),
+    default="text",
+    help="jsonl streams a JSON record per tag and commit as soon as it is found",
+)
+@click.option(
+    "--order",
+    type=click.Choice(["stable", "completion"]),
+    default="stable",
+    help="Order of the jsonl records, stable is the same for every run",
+)
 @add_options(common_options)
-def search(repo, depth, template, tags, verbose, yes):
+def search(
+    repo, depth, template, tags, engine, jobs, local_mirror, output, order, verbose, yes
+):
 
-    setup_logger(stream_level="DEBUG" if verbose else "INFO")
+    # Keep stdout for the records
+    setup_logger(
+        stream_level="DEBUG" if verbose else "INFO",
+        stream=sys.stderr if output == "jsonl" else None,
+    )
 
     validator = Validation()
 
@@ -328,7 +415,7 @@ def search(repo, depth, template, tags, verbose, yes):
 
     if template is not None:
         template = comm.get_template_version_dataclass(template, repo)
-        cli = GHCli()
+        cli = get_gh_client()
         cli.cw_repo = repo
         templates = util.search_templates(cli, template.ref)
         if templates:
@@ -348,7 +435,9 @@ def search(repo, depth, template, tags, verbose, yes):
     if not yes:
         validator.confirm_command_execution(repo=repo.full_name, depth=depth)
 
-    archctl.search(repo, depth, tags, template)
+    archctl.search(
+        repo, depth, tags, template, engine, jobs, local_mirror, output, order
+    )
 
 
 @main.command()
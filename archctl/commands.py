@@ -3,7 +3,7 @@ import archctl.main as archctl
 from archctl.validation import Validation
 import archctl.commons as comm
 from archctl.prompts import IPPrompt
-from archctl.github import GHCli
+from archctl.github import get_gh_client
 from archctl.user_config import JSONConfig
 from archctl.utils import search_templates
 
@@ -39,7 +39,7 @@ class Register(Command):
     def __init__(self):
         self.prompt = IPPrompt()
         self.validator = Validation(True)
-        self.cli = GHCli()
+        self.cli = get_gh_client()
 
     def run(self):
         repo = comm.get_repo_dataclass(self.prompt.repo_text([1, 0]))
@@ -85,7 +85,7 @@ class Create(Command):
     def __init__(self):
         self.prompt = IPPrompt()
         self.validator = Validation(True)
-        self.cli = GHCli()
+        self.cli = get_gh_client()
 
     def run(self):
 
@@ -129,7 +129,7 @@ class Create(Command):
 class Render(Command):
     def __init__(self):
         self.prompt = IPPrompt()
-        self.cli = GHCli()
+        self.cli = get_gh_client()
         self.uc = JSONConfig()
 
     def __p_repo_manually(self):
@@ -243,7 +243,7 @@ class Upgrade(Render):
     def __init__(self):
         self.prompt = IPPrompt()
         self.validator = Validation(True)
-        self.cli = GHCli()
+        self.cli = get_gh_client()
 
     def run(self):
 
@@ -272,7 +272,7 @@ class Preview(Render):
     def __init__(self):
         self.prompt = IPPrompt()
         self.validator = Validation(True)
-        self.cli = GHCli()
+        self.cli = get_gh_client()
         self.uc = JSONConfig()
 
     def __p_repo(self):
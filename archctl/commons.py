@@ -1,11 +1,84 @@
+import functools
+import json
 import logging
+import re
+import shutil
 from dataclasses import dataclass, is_dataclass, asdict
+from os import environ
+from pathlib import Path
 import subprocess
+import threading
+import time
 
 from json import JSONEncoder
 
 logger = logging.getLogger(__name__)
 
+# Seconds a successful auth verification is trusted by later archctl calls.
+# Disabled by default, opt in with the ARCHCTL_AUTH_TTL env var
+AUTH_STAMP_TTL = 0
+
+logged_user_pattern = re.compile(r"Logged in to \S+ (?:as|account) (\S+)")
+
+# Directory where archctl persists caches between runs
+CACHE_DIR = Path(
+    environ.get("ARCHCTL_CACHE_DIR")
+    or Path(environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "archctl"
+)
+
+
+def dir_size(path: Path):
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file() and not f.is_symlink())
+
+
+def cache_stamp(entry: Path) -> Path:
+    """File next to an entry of a cache dir holding its size, touched every
+    time the entry is used so its mtime tells which entries are older"""
+
+    return entry.with_name(f"{entry.name}.used")
+
+
+def touch_cache_entry(entry: Path, measure=False):
+    """Mark the entry as used, measuring it the first time or when measure is
+    set, for entries that just changed"""
+
+    stamp = cache_stamp(entry)
+    if stamp.exists() and not measure:
+        stamp.touch()
+    else:
+        stamp.write_text(str(dir_size(entry)))
+
+
+def evict_cache_dir(cache_dir: Path, max_size, keep=(), pattern="*"):
+    """Remove the least recently used entries of the cache dir, the dirs
+    matching pattern, and their stamps until under max_size. Entries in keep
+    are never removed"""
+
+    usage = {}
+    for entry in cache_dir.glob(pattern):
+        # Hidden dirs are entries still being created
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+
+        stamp = cache_stamp(entry)
+        try:
+            usage[entry] = (stamp.stat().st_mtime, int(stamp.read_text()))
+        except (OSError, ValueError):
+            usage[entry] = (0, dir_size(entry))
+
+    size = sum(entry_size for _, entry_size in usage.values())
+
+    for entry in sorted(usage, key=lambda e: usage[e][0]):
+        if size <= max_size:
+            break
+        if entry in keep:
+            continue
+
+        logger.debug(f"Evicting {entry} from the cache")
+        shutil.rmtree(entry, ignore_errors=True)
+        cache_stamp(entry).unlink(missing_ok=True)
+        size -= usage[entry][1]
+
 
 class EnhancedJSONEncoder(JSONEncoder):
     def default(self, o):
@@ -121,45 +194,119 @@ def get_template_version_dataclass(
     return TemplateVersion(template, ref)
 
 
-def auth_status():
-    """Check if user is logged in via gh CLI"""
+class AuthSession:
+    """Credentials of the gh CLI user, verified once per process. With a ttl,
+    the login of the last verification is persisted for ttl seconds, so
+    consecutive archctl calls don't have to ask gh again. The token itself
+    is never written to disk"""
 
-    cmd = "gh auth status"
+    def __init__(self, stamp_path: Path, ttl):
+        self.stamp_path = stamp_path
+        self.ttl = ttl
+        self._login = None
+        self._token = None
+        self._lock = threading.Lock()
 
-    try:
-        subprocess.run(cmd.split(), capture_output=True, check=True)
-        logger.debug("User is logged in")
-        return True
+    def __read_stamp(self):
+        """Get the login of a still valid verification stamp, if any"""
 
-    except subprocess.CalledProcessError:
-        logger.error(
-            "User is not logged in GitHub CLI, please log in before using archctl"
-        )
-        exit(1)
+        try:
+            stamp = json.loads(self.stamp_path.read_text())
+        except (OSError, ValueError):
+            return None
 
+        if time.time() - stamp.get("verified", 0) > self.ttl:
+            return None
 
-def __get_user_token():
-    """Get the user token"""
+        return stamp.get("login")
 
-    cmd = "gh auth token"
+    def __write_stamp(self):
+        try:
+            self.stamp_path.parent.mkdir(parents=True, exist_ok=True)
+            self.stamp_path.write_text(
+                json.dumps({"login": self._login, "verified": time.time()})
+            )
+            self.stamp_path.chmod(0o600)
+        except OSError:
+            logger.debug("Could not persist the auth verification stamp")
 
-    try:
-        output = subprocess.run(cmd.split(), capture_output=True, check=True)
-        return output.stdout.decode()[:-1]
+    def verify(self):
+        """Check, once, that the user is logged in via gh CLI, exits otherwise"""
 
-    except subprocess.CalledProcessError:
-        print("Couldn't get the gh token")
+        with self._lock:
+            if self._login is not None:
+                return True
 
+            if self.ttl > 0 and (login := self.__read_stamp()):
+                logger.debug("User is logged in (cached verification)")
+                self._login = login
+                return True
 
-def get_logged_user():
-    """Get the logged in user name via gh CLI"""
+            cmd = "gh auth status"
 
-    cmd = "gh auth status"
+            try:
+                output = subprocess.run(cmd.split(), capture_output=True, check=True)
 
-    if auth_status():
-        status = subprocess.getoutput(cmd).split()
-        user = status[status.index("as") + 1]
-        return user
+            except subprocess.CalledProcessError:
+                logger.error(
+                    "User is not logged in GitHub CLI, please log in before using archctl"
+                )
+                exit(1)
 
-    else:
-        return False
+            # Older gh versions print the status to stderr
+            status = output.stdout.decode() + output.stderr.decode()
+            match = logged_user_pattern.search(status)
+            self._login = match.group(1) if match else ""
+            logger.debug("User is logged in")
+
+            if self.ttl > 0 and self._login:
+                self.__write_stamp()
+
+            return True
+
+    @property
+    def login(self):
+        """Name of the logged in user"""
+
+        self.verify()
+        return self._login
+
+    @property
+    def token(self):
+        """Token of the logged in user, requested to gh only once"""
+
+        with self._lock:
+            if self._token is None:
+                cmd = "gh auth token"
+
+                try:
+                    output = subprocess.run(cmd.split(), capture_output=True, check=True)
+                    self._token = output.stdout.decode().strip()
+
+                except subprocess.CalledProcessError:
+                    print("Couldn't get the gh token")
+
+            return self._token
+
+
+@functools.cache
+def get_auth_session() -> AuthSession:
+    """Process wide auth session"""
+
+    ttl = int(environ.get("ARCHCTL_AUTH_TTL", AUTH_STAMP_TTL))
+    return AuthSession(CACHE_DIR / "auth.json", ttl)
+
+
+def auth_status():
+    """Check if user is logged in via gh CLI"""
+    return get_auth_session().verify()
+
+
+def get_user_token():
+    """Get the user token"""
+    return get_auth_session().token
+
+
+def get_logged_user():
+    """Get the logged in user name via gh CLI"""
+    return get_auth_session().login
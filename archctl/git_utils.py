@@ -1,11 +1,87 @@
 import difflib
+import hashlib
+import itertools
+from dataclasses import dataclass
+from operator import itemgetter
 from pathlib import Path
+from typing import Iterator
 
 from git.repo import Repo
 
+from archctl.repo_cache import get_repo_cache
 
-def clone_repo(repo, path):
-    return Repo.clone_from(repo.ssh_url, path)
+
+# Options of git clone for each strategy: shallow only gets the tip of the
+# branch, blobless gets the whole history but fetches the files on demand and
+# sparse, on top of that, only checks out the files at the root of the repo.
+# Mirror checks out a worktree of the cached mirror of registered repos, the
+# rest are cloned shallow
+CLONE_STRATEGIES = {
+    "full": [],
+    "shallow": ["--depth=1", "--single-branch"],
+    "blobless": ["--filter=blob:none"],
+    "sparse": ["--filter=blob:none", "--sparse"],
+    "mirror": ["--depth=1", "--single-branch"],
+}
+
+
+# Bytes at the start of a blob looked at to tell binary files, as git does
+SNIFF_SIZE = 8000
+
+# Max bytes read from a blob at once when streaming its lines
+CHUNK_SIZE = 65536
+
+# Max chars of diff shown for a single file and for all of them
+MAX_FILE_DIFF = 64 * 1024
+MAX_TOTAL_DIFF = 1024 * 1024
+
+# Blobs bigger than this aren't diffed, difflib is too slow on them
+MAX_DIFF_BLOB = 1024 * 1024
+
+TRUNCATED = "... diff truncated"
+
+
+def clone_repo(repo, path, strategy="full", branch=None):
+    """Clone the repo with the given strategy, checking out branch (the default
+    one if None) as that's the only one shallow clones get"""
+    if strategy == "mirror" and branch is not None:
+        cache = get_repo_cache()
+        if cache.is_registered(repo):
+            return cache.worktree(repo, branch, path)
+
+    options = list(CLONE_STRATEGIES[strategy])
+    if branch is not None and strategy != "full":
+        options.append(f"--branch={branch}")
+    return Repo.clone_from(repo.ssh_url, path, multi_options=options)
+
+
+def sparse_checkout_add(repo, dirs):
+    """Add the dirs to the sparse checkout of the repo, so they can be committed"""
+    if dirs and repo.git.config("--bool", "core.sparseCheckout", with_exceptions=False) == "true":
+        repo.git.sparse_checkout("add", *dirs)
+
+
+def stage_unchanged(repo, path, base):
+    """Stage the changes under path, returns true if the staged tree is the
+    same as the one of the base commit, meaning there's nothing to commit"""
+    repo.git.add(path)
+    return repo.git.write_tree() == repo.git.rev_parse(f"{base}^{{tree}}")
+
+
+def blob_entry(path):
+    """Mode and content of the file as git would store them in a tree, symlinks
+    are stored as their target"""
+    path = Path(path)
+    if path.is_symlink():
+        return "120000", str(path.readlink()).encode()
+
+    mode = "100755" if path.stat().st_mode & 0o100 else "100644"
+    return mode, path.read_bytes()
+
+
+def blob_sha(content):
+    """SHA git gives to the content as a blob, without writing it anywhere"""
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
 
 
 def commit_changes(repo, path, message):
@@ -33,58 +109,161 @@ def publish_branch(repo, branch):
     repo.git.push("--set-upstream", "origin", branch)
 
 
-def diff_branches(repo, branch):
+def sniff(blob):
+    """Tell if the blob is binary by looking for NUL bytes in its first
+    SNIFF_SIZE bytes, like git does. Returns it along with the lines of the
+    blob, only read from the object database as they are consumed"""
 
-    # The last commit in the current branch
-    commit_feature = repo.head.commit.tree
+    stream = blob.data_stream
+    head = stream.read(SNIFF_SIZE)
+    chunks = itertools.chain([head], iter(lambda: stream.read(CHUNK_SIZE), b""))
 
-    # The last commit in the target branch
-    commit_origin_dev = repo.commit(f"origin/{branch}")
+    return b"\0" in head, split_lines(chunks)
 
-    # Get the iterator with all the diffs between both commits
-    diff_index = commit_origin_dev.diff(commit_feature)
 
-    # Differ for generating the diff strings
-    differ = difflib.Differ()
+def split_lines(chunks, sep=b"\n"):
+    """Decoded lines out of chunks of bytes, split anywhere"""
 
-    # Collection all new files
-    added = []
-    for diff in diff_index.iter_change_type("A"):
-        # Get the content of the blob of the newly created file
-        blob = diff.b_blob.data_stream.read().decode("utf-8").splitlines()
+    rest = b""
+    for chunk in chunks:
+        *lines, rest = (rest + chunk).split(sep)
+        for line in lines:
+            yield line.decode("utf-8", "replace")
 
-        # Get the name of the file
-        name = Path(diff.b_path).name
+    if rest:
+        yield rest.decode("utf-8", "replace")
 
-        # Get the changes to the file as diff
-        difference = list(differ.compare("", blob))
 
-        # Add the dictionary with the name and diff to the list of added files
-        added.append({"name": name, "diff": difference})
+def bounded(lines, max_file, budget):
+    """Pass the lines through until the file takes max_file chars or the total
+    budget of chars runs out, then mark the diff as truncated"""
 
-    # Collection all deleted files
-    deleted = []
-    for diff in diff_index.iter_change_type("D"):
+    size = 0
+    for line in lines:
+        size += len(line) + 1
+        if size > max_file or len(line) + 1 > budget["total"]:
+            yield TRUNCATED
+            return
+
+        budget["total"] -= len(line) + 1
+        yield line
+
+
+def added_lines(blob):
+    binary, lines = sniff(blob)
+    if binary:
+        yield "Binary file"
+        return
+
+    # Nothing to compare to, the lines are streamed as they are read
+    for line in lines:
+        yield "+" + line
 
-        # Get the name of the file
-        name = Path(diff.a_path).name
 
-        deleted.append(name)
+def modified_lines(diff):
+    if max(diff.a_blob.size, diff.b_blob.size) > MAX_DIFF_BLOB:
+        yield f"File too big to diff ({diff.a_blob.size} -> {diff.b_blob.size} bytes)"
+        return
+
+    a_binary, a_lines = sniff(diff.a_blob)
+    b_binary, b_lines = sniff(diff.b_blob)
+    if a_binary or b_binary:
+        yield "Binary files differ"
+        return
+
+    yield from difflib.unified_diff(
+        list(a_lines), list(b_lines), f"a/{diff.a_path}", f"b/{diff.b_path}", lineterm=""
+    )
+
+
+@dataclass
+class FileDiff:
+    """Change to a file between two commits, the lines of its diff are only
+    generated when iterated"""
+
+    change: str
+    path: str
+    lines: Iterator[str]
+
+
+def diff_branches(repo, branch, added=True, max_file=MAX_FILE_DIFF, max_total=MAX_TOTAL_DIFF):
+    """Lazily yield the diffs of the files between origin/branch and the
+    current commit: the added files first, then the deleted and the modified
+    ones. The added files come without lines unless added. Diffs are cut at
+    max_file chars for a file and max_total chars among all of them,
+    consumers must go through them in order"""
+
+    diff_index = repo.commit(f"origin/{branch}").diff(repo.head.commit.tree)
+    budget = {"total": max_total}
+
+    for diff in diff_index.iter_change_type("A"):
+        lines = added_lines(diff.b_blob) if added else iter(())
+        yield FileDiff("A", diff.b_path, bounded(lines, max_file, budget))
+
+    for diff in diff_index.iter_change_type("D"):
+        yield FileDiff("D", diff.a_path, iter(()))
 
-    # Collection all modified files
-    modified = []
     for diff in diff_index.iter_change_type("M"):
-        # Get the contents of the blobs
-        a_content = diff.a_blob.data_stream.read().decode("utf-8").splitlines()
-        b_content = diff.b_blob.data_stream.read().decode("utf-8").splitlines()
+        yield FileDiff("M", diff.b_path, bounded(modified_lines(diff), max_file, budget))
+
+
+def stream_lines(repo, *args, sep=b"\n"):
+    """Lazily yield the decoded lines git prints for the command, which is
+    killed if the consumer stops early"""
+
+    process = repo.git.execute(["git", *args], as_process=True)
+    try:
+        yield from split_lines(iter(lambda: process.stdout.read(CHUNK_SIZE), b""), sep)
+    finally:
+        process.proc.kill()
+        process.proc.wait()
+
+
+def number_files(patch):
+    """Pair each line of the patch with the number of its file, every file
+    starts with a diff --git line, in the same order git lists their names"""
+
+    file = -1
+    for line in patch:
+        if line.startswith("diff --git "):
+            file += 1
+        yield file, line
+
+
+def git_diff_branches(repo, branch, added=True, max_file=MAX_FILE_DIFF, max_total=MAX_TOTAL_DIFF):
+    """Same as diff_branches, out of the patches of git diff, streamed as git
+    prints them. A git diff is run for each kind of change, the ones of the
+    added files only if added"""
+
+    base = f"origin/{branch}"
+    budget = {"total": max_total}
+
+    for change in ("A", "D", "M"):
+        args = ["--no-renames", "--no-ext-diff", "--no-color", f"--diff-filter={change}", base, "HEAD"]
+        paths = list(filter(None, repo.git.diff("--name-only", "-z", *args).split("\0")))
+        if not paths:
+            continue
+
+        if change == "D" or (change == "A" and not added):
+            for path in paths:
+                yield FileDiff(change, path, iter(()))
+            continue
+
+        patch = itertools.groupby(number_files(stream_lines(repo, "diff", "--patch", *args)), itemgetter(0))
+        for path, (_, lines) in zip(paths, patch):
+            yield FileDiff(change, path, bounded((line for _, line in lines), max_file, budget))
+
 
-        # Get the name of the file
-        name = Path(diff.b_path).name
+def diff_stat(repo, branch):
+    """Lazily yield the path, added and deleted lines of every file changed
+    between origin/branch and the current commit, counted by git. The counts
+    of binary files are None"""
 
-        difference = difflib.context_diff(
-            a_content, b_content, Path(diff.a_path).name, Path(diff.b_path).name
-        )
+    args = ["diff", "--numstat", "-z", "--no-renames", f"origin/{branch}", "HEAD"]
+    for record in stream_lines(repo, *args, sep=b"\0"):
+        added, deleted, path = record.split("\t", 2)
+        yield path, None if added == "-" else int(added), None if deleted == "-" else int(deleted)
 
-        modified.append({"name": name, "diff": difference})
 
-    return {"A": added, "D": deleted, "M": modified}
+# Diff engines preview can use, difflib over the blobs or git itself
+DIFF_BACKENDS = {"python": diff_branches, "git": git_diff_branches}
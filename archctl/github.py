@@ -1,14 +1,58 @@
+import base64
+import functools
 import logging
+import os
+import re
 import subprocess
+import threading
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass
+from urllib.parse import quote, urlencode, urlsplit
 
 import json
 
+import requests
+from requests.adapters import HTTPAdapter
+
 import archctl.commons as comm
+from archctl.http_cache import get_cache, is_immutable
+from archctl.ratelimit import get_scheduler
+from archctl.user_config import JSONConfig
 
 logger = logging.getLogger(__name__)
 
-# api_github = "https://api.github.comm"
+API_URL = os.environ.get("ARCHCTL_GH_API_URL", "https://api.github.com")
+
+# Max number of keep-alive connections kept open against the API
+POOL_SIZE = 16
+
+# Seconds to wait for the API before giving up on a request
+TIMEOUT = 30
+
+# Items requested per page on paginated endpoints (max allowed by GitHub)
+PER_PAGE = 100
+
+link_next_pattern = re.compile('<([^>]+)>; rel="next"')
+sha_pattern = re.compile("[0-9a-f]{40}")
+
+# Max number of pages memoized, the least recently used ones are dropped first
+MEMO_SIZE = 1024
+
+# Pages already requested in this process, shared by every controller
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+@dataclass
+class Response:
+    status: int
+    headers: dict
+    text: str
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
 
 
 class GithubIface(ABC):
@@ -31,7 +75,7 @@ class GithubIface(ABC):
 
     @abstractmethod
     def list_branches(self):
-        """Returns a list of the"""
+        """Lazily iterate over all the branches of the repo"""
         raise NotImplementedError
 
     @abstractmethod
@@ -40,13 +84,18 @@ class GithubIface(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def get_commits(self, path=None):
-        """Comment"""
+    def get_commits(self, path=None, sha=None, per_page=PER_PAGE):
+        """Lazily iterate over the commits of the repo, newest first"""
         raise NotImplementedError
 
     @abstractmethod
     def list_tags(self):
-        """Comment"""
+        """Lazily iterate over all the tags in the repo"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_tree_sha(self, ref=None):
+        """Get the SHA of the root tree at the given ref, default branch if None"""
         raise NotImplementedError
 
     @abstractmethod
@@ -54,6 +103,11 @@ class GithubIface(ABC):
         """Get a tree of the given repo, if sha is None, get the root tree of the repo"""
         raise NotImplementedError
 
+    @abstractmethod
+    def graphql(self, query, variables=None):
+        """Run a GraphQL query, returns the data of the response"""
+        raise NotImplementedError
+
     @abstractmethod
     def create_repo(self, description="", private=False):
         """Comment"""
@@ -81,10 +135,38 @@ class GithubIface(ABC):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def get_file(self, path, ref=None) -> bytes | None:
+        """Get the content of a file at the given ref, None if there's no such file"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_blob(self, content: bytes) -> str | None:
+        """Upload the content as a blob, returns its SHA"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_tree(self, entries, base_tree=None) -> str | None:
+        """Create a tree out of base_tree with the given entries replaced,
+        returns its SHA"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_commit(self, message, tree, parents) -> str | None:
+        """Create a commit of the tree on top of the parents, returns its SHA"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_ref(self, branch, sha) -> bool:
+        """Create the branch pointing to the commit"""
+        raise NotImplementedError
+
+
+class GHBase(GithubIface):
+    """REST read requests shared by every GitHub controller, subclasses
+    only provide the transport used to reach the API"""
 
-class GHCli(GithubIface):
     def __init__(self):
-        comm.auth_status()
         self._cw_repo: comm.Repo = comm.Repo(None, None, None, None, None, None)
 
     @property
@@ -102,30 +184,137 @@ class GHCli(GithubIface):
                 "Formato de repo no reconocido al establecer el cw_repo de GHCli"
             )
 
-    def __get_request(self, request):
-        """Makes a get request via gh cli"""
+    @abstractmethod
+    def _send(self, request, headers) -> Response | None:
+        """Sends a get request to the GH API with the given extra headers,
+        returns None if the request couldn't be made"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _write(self, method, request, body=None) -> Response | None:
+        """Makes a request that modifies a repo, returns None if the request
+        couldn't be made"""
+        raise NotImplementedError
+
+    def _get_request(self, request):
+        """Makes a get request to the GH API, returns {} on failure"""
+        return self._get_page(request)[0]
 
-        cmd = f"gh api {request}"
+    def _paginate(self, request):
+        """Lazily yield the items of a paginated endpoint, following the Link
+        headers so no page is requested until the previous one is consumed"""
 
-        try:
-            logger.debug(f"Making request {request} to GH API via GH CLI")
-            response = subprocess.getoutput(cmd)
-            return json.loads(response)
+        while request is not None:
+            data, request = self._get_page(request)
 
-        except subprocess.CalledProcessError:
-            logger.debug("Problem running the GitHub CLI command")
-            return {}
+            if not isinstance(data, list):
+                return
+
+            yield from data
+
+    def __next_request(self, link):
+        """Get the request of the next page from a Link header"""
+
+        if not link or not (match := link_next_pattern.search(link)):
+            return None
+
+        url = match.group(1)
+        if url.startswith(f"{API_URL}/"):
+            return url[len(API_URL) + 1:]
+
+        url = urlsplit(url)
+        return f"{url.path.lstrip('/')}?{url.query}"
+
+    def _get_page(self, request):
+        """Makes a get request to the GH API, returns the data along with the
+        request of the next page, if any. Data is {} on failure
+
+        Successful responses are memoized for the rest of the process, so each
+        distinct fact is only requested once per command. Content-addressed
+        ones aren't, the HTTP cache serves them without reaching the API
+        """
+
+        with _memo_lock:
+            if request in _memo:
+                _memo.move_to_end(request)
+                return _memo[request]
+
+        page = self.__fetch_page(request)
+
+        if page[0] and not is_immutable(request):
+            with _memo_lock:
+                _memo[request] = page
+                while len(_memo) > MEMO_SIZE:
+                    _memo.popitem(last=False)
+
+        return page
+
+    def _forget(self):
+        """Drop the memoized responses after modifying a repo"""
+
+        with _memo_lock:
+            _memo.clear()
+
+    def __fetch_page(self, request):
+        """Makes a get request to the GH API, returns the data along with the
+        request of the next page, if any. Data is {} on failure
+
+        Responses are kept in the HTTP cache, content-addressed ones are served
+        from it directly and the rest are revalidated with a conditional request
+        """
+
+        cache = get_cache()
+        key = f"{API_URL}/{request}"
+        entry = cache.get(key)
+
+        if entry is not None and is_immutable(request):
+            cache.count(hits=1)
+            return json.loads(entry.body), self.__next_request(entry.link)
+
+        headers = {}
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+
+        response = get_scheduler().send(
+            functools.partial(self._send, request, headers)
+        )
+
+        if response is None:
+            return {}, None
+
+        if response.status == 304 and entry is not None:
+            cache.count(hits=1, revalidated=1)
+            return json.loads(entry.body), self.__next_request(entry.link)
+
+        cache.count(misses=1)
+
+        if not response.ok:
+            logger.debug(f"GitHub API answered {response.status} to {request}")
+            return {}, None
+
+        try:
+            data = json.loads(response.text)
 
         except ValueError:
             logger.debug("Problem decoding GitHub API response")
-            return {}
+            return {}, None
+
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        link = response.headers.get("link")
+        if etag or last_modified or is_immutable(request):
+            cache.put(key, response.text, etag, last_modified, link)
+
+        return data, self.__next_request(link)
 
     def get_repo_info(self):
         """Get the general info of a repo"""
 
         request = f"repos/{self.cw_repo.full_name}"
 
-        return self.__get_request(request)
+        return self._get_request(request)
 
     def get_default_branch(self):
         """Return the default branch of the given repo"""
@@ -136,56 +325,243 @@ class GHCli(GithubIface):
 
         request = f"repos/{self.cw_repo.full_name}/branches/{branch}"
 
-        return self.__get_request(request)
+        return self._get_request(request)
 
     def list_branches(self):
-        """Returns a list of the"""
+        """Lazily iterate over all the branches of the repo"""
 
-        request = f"repos/{self.cw_repo.full_name}/branches"
+        request = f"repos/{self.cw_repo.full_name}/branches?per_page={PER_PAGE}"
 
-        return self.__get_request(request)
+        return self._paginate(request)
 
     def branch_exists(self, branch):
         """Comment"""
 
-        branches = [branch["name"] for branch in self.list_branches()]
+        return any(b["name"] == branch for b in self.list_branches())
 
-        return branch in branches
+    def get_commits(self, path=None, sha=None, per_page=PER_PAGE):
+        """Lazily iterate over the commits of the repo, newest first. Consumers
+        that only need the first N commits should ask for per_page=N"""
 
-    def get_commits(self, path=None, sha=None):
-        """Comment"""
+        params = {}
 
-        request = f"repos/{self.cw_repo.full_name}/commits"
+        if sha is not None:
+            params["sha"] = sha
+        if path is not None:
+            params["path"] = path
 
-        if path is not None and sha is None:
-            request += f"?path={path}"
-        elif path is None and sha is not None:
-            request += f"?sha={sha}"
-        elif path is not None and sha is not None:
-            request += f"?sha={sha}&path={path}"
+        params["per_page"] = min(per_page, PER_PAGE)
 
-        return self.__get_request(request)
+        request = f"repos/{self.cw_repo.full_name}/commits?{urlencode(params, safe='/')}"
+
+        return self._paginate(request)
 
     def list_tags(self):
-        """Lists all tags in the repo"""
+        """Lazily iterate over all the tags in the repo"""
+
+        request = f"repos/{self.cw_repo.full_name}/tags?per_page={PER_PAGE}"
 
-        request = f"repos/{self.cw_repo.full_name}/tags"
+        return self._paginate(request)
 
-        return self.__get_request(request)
+    def get_tree_sha(self, ref=None):
+        """Get the SHA of the root tree at the given ref, default branch if None.
+        Commits are addressed by SHA, so resolving them is served by the cache"""
+
+        if ref is None:
+            ref = self.get_default_branch()
+
+        if sha_pattern.fullmatch(ref):
+            commit = self._get_request(f"repos/{self.cw_repo.full_name}/git/commits/{ref}")
+            return commit.get("tree", {}).get("sha")
+
+        branch = self.get_branch_info(ref)
+        if branch:
+            return branch["commit"]["commit"]["tree"]["sha"]
+
+        # Tags and any other ref
+        commit = self._get_request(f"repos/{self.cw_repo.full_name}/commits/{ref}")
+        return commit.get("commit", {}).get("tree", {}).get("sha")
 
     def get_tree(self, ref=None, recursive="0"):
-        """Get a tree of the given repo, if sha is None, get the root tree of the repo"""
+        """Get a tree of the given repo, if sha is None, get the root tree of the repo.
+        GitHub recurses on any value of the recursive param, so it is only sent when
+        recursive is truthy. Big recursive trees come back with truncated set"""
 
         if ref is None:
             ref = self.get_default_branch()
 
-        request = f"repos/{self.cw_repo.full_name}/git/trees/{ref}?recursive=0"
+        request = f"repos/{self.cw_repo.full_name}/git/trees/{ref}"
+        if recursive not in (None, False, 0, "0", "false"):
+            request += "?recursive=1"
+
+        return self._get_request(request)
+
+    def get_file(self, path, ref=None):
+        """Get the content of a file at the given ref, default branch if None.
+        None if there's no such file or it's a dir"""
+
+        request = f"repos/{self.cw_repo.full_name}/contents/{quote(path)}"
+        if ref is not None:
+            request += f"?ref={quote(ref, safe='')}"
+
+        content = self._get_request(request)
+
+        if not isinstance(content, dict) or content.get("type") != "file":
+            return None
+
+        return base64.b64decode(content.get("content", ""))
+
+    def __created(self, response, what):
+        """Get the SHA of the object created by a write, None on failure"""
+
+        if response is None or not response.ok:
+            logger.debug(f"Could not create the {what}")
+            return None
+
+        try:
+            return json.loads(response.text)["sha"]
+
+        except (ValueError, KeyError):
+            logger.debug("Problem decoding GitHub API response")
+            return None
+
+    def create_blob(self, content: bytes):
+        """Upload the content as a blob, returns its SHA"""
+
+        request = f"repos/{self.cw_repo.full_name}/git/blobs"
+        body = {"content": base64.b64encode(content).decode(), "encoding": "base64"}
+
+        return self.__created(self._write("POST", request, body), "blob")
+
+    def create_tree(self, entries, base_tree=None):
+        """Create a tree out of base_tree with the given entries replaced, each
+        one a dict with the path, mode, type and sha of a git tree entry. A
+        None sha deletes the path. Returns the SHA of the tree"""
+
+        request = f"repos/{self.cw_repo.full_name}/git/trees"
+        body = {"tree": entries}
+
+        if base_tree is not None:
+            body["base_tree"] = base_tree
+
+        return self.__created(self._write("POST", request, body), "tree")
+
+    def create_commit(self, message, tree, parents):
+        """Create a commit of the tree on top of the parents, returns its SHA"""
+
+        request = f"repos/{self.cw_repo.full_name}/git/commits"
+        body = {"message": message, "tree": tree, "parents": list(parents)}
+
+        return self.__created(self._write("POST", request, body), "commit")
+
+    def create_ref(self, branch, sha):
+        """Create the branch pointing to the commit"""
+
+        request = f"repos/{self.cw_repo.full_name}/git/refs"
+        body = {"ref": f"refs/heads/{branch}", "sha": sha}
+
+        response = self._write("POST", request, body)
+
+        if response is None or not response.ok:
+            logger.debug(f"Could not create the branch {branch}")
+            return False
+
+        return True
+
+
+class GHCli(GHBase):
+    def __init__(self):
+        comm.auth_status()
+        super().__init__()
+
+    def _send(self, request, headers):
+        """Makes a get request via gh cli, including the response headers"""
+
+        cmd = ["gh", "api", "-i", request]
+        for name, value in headers.items():
+            cmd += ["-H", f"{name}: {value}"]
+
+        try:
+            logger.debug(f"Making request {request} to GH API via GH CLI")
+            output = subprocess.run(cmd, capture_output=True, text=True).stdout
+
+        except OSError:
+            logger.debug("Problem running the GitHub CLI command")
+            return None
+
+        return self.__parse_response(output)
 
-        return self.__get_request(request)
+    def __parse_response(self, output):
+        """Parse the status line, headers and body printed by gh api -i"""
+
+        head, _, body = output.replace("\r\n", "\n").partition("\n\n")
+        lines = head.split("\n")
+        status = lines[0].split()
+
+        if len(status) < 2 or not status[1].isdigit():
+            logger.debug("Problem decoding GitHub CLI output")
+            return None
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        return Response(int(status[1]), headers, body)
+
+    def _write(self, method, request, body=None):
+        """Makes a request that modifies a repo via gh cli, through the rate
+        limit scheduler"""
+
+        self._forget()
+
+        cmd = ["gh", "api", "-i", "-X", method, request, "--input", "-"]
+
+        def send():
+            try:
+                logger.debug(f"Making {method} request {request} to GH API via GH CLI")
+                output = subprocess.run(cmd, input=json.dumps(body or {}), capture_output=True, text=True)
+                return self.__parse_response(output.stdout)
+
+            except OSError:
+                logger.debug("Problem running the GitHub CLI command")
+                return None
+
+        return get_scheduler().send(send)
+
+    def graphql(self, query, variables=None):
+        """Run a GraphQL query via gh cli, returns the data of the response"""
+
+        body = json.dumps({"query": query, "variables": variables or {}})
+        cmd = ["gh", "api", "-i", "graphql", "--input", "-"]
+
+        def send():
+            try:
+                logger.debug("Making GraphQL query to GH API via GH CLI")
+                output = subprocess.run(cmd, input=body, capture_output=True, text=True)
+                return self.__parse_response(output.stdout)
+
+            except OSError:
+                logger.debug("Problem running the GitHub CLI command")
+                return None
+
+        response = get_scheduler("graphql").send(send)
+
+        if response is None:
+            return {}
+
+        try:
+            return _graphql_data(json.loads(response.text))
+
+        except ValueError:
+            logger.debug("Problem decoding GitHub API response")
+            return {}
 
     def create_repo(self, description="", private=True):
         """Comment"""
 
+        self._forget()
+
         cmd = f"gh repo create {self.cw_repo.full_name} --add-readme -d '{description}'"
 
         if private:
@@ -215,6 +591,8 @@ class GHCli(GithubIface):
         if branch is not None:
             body["branch"] = branch
 
+        self._forget()
+
         cmd1 = ["echo", "-n", json.dumps(body)]
 
         cmd2 = ["gh", "api", "-X", "PUT", request, "--input", "-"]
@@ -239,6 +617,8 @@ class GHCli(GithubIface):
     def delete_repo(self, confirm=True):
         """Comment"""
 
+        self._forget()
+
         cmd = f"gh repo delete {self.cw_repo.full_name}"
 
         if confirm:
@@ -260,11 +640,224 @@ class GHCli(GithubIface):
         Head branch what to merge
         """
 
-        cmd = f'gh pr create -R {self.cw_repo.full_name} -B {base} -H {head} -t "{title}" -b ""'
+        cmd = ["gh", "pr", "create", "-R", self.cw_repo.full_name, "-B", base, "-H", head, "-t", title, "-b", ""]
 
         try:
-            print(subprocess.getoutput(cmd))
+            output = subprocess.run(cmd, capture_output=True, text=True)
 
-        except subprocess.CalledProcessError:
+        except OSError:
+            logger.debug("Problem running the GitHub CLI command")
+            return False
+
+        if output.returncode != 0:
+            logger.debug(f"Could not create the PR: {output.stderr.strip()}")
+            return False
+
+        print(output.stdout.strip())
+
+        return True
+
+
+def _graphql_data(response):
+    """Get the data of a GraphQL response, logging the errors it contains"""
+
+    for error in response.get("errors", []):
+        logger.debug(f"GraphQL error: {error.get('message')}")
+
+    return response.get("data") or {}
+
+
+@functools.cache
+def _api_session():
+    """Process wide pool of keep-alive connections to the GH API, the token
+    is only requested once per process"""
+
+    token = (
+        os.environ.get("GH_TOKEN")
+        or os.environ.get("GITHUB_TOKEN")
+        or comm.get_user_token()
+    )
+
+    if not token:
+        logger.error(
+            "User is not logged in GitHub CLI, please log in before using archctl"
+        )
+        exit(1)
+
+    session = requests.Session()
+    session.headers.update(
+        {
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28",
+        }
+    )
+
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+class GHApi(GHBase):
+    """GitHub controller that talks to the REST API directly, reusing the
+    same connection pool for every request instead of spawning gh"""
+
+    def __init__(self):
+        super().__init__()
+        self._session = _api_session()
+
+    def __request(self, method, url, body=None, headers=None):
+        """Makes a request to the GH API, returns None if it couldn't be sent"""
+
+        try:
+            logger.debug(f"Making {method} request {url} to GH API")
+            response = self._session.request(
+                method, url, json=body, headers=headers, timeout=TIMEOUT
+            )
+
+        except requests.RequestException:
+            logger.debug("Problem connecting to the GitHub API")
+            return None
+
+        return Response(
+            response.status_code,
+            {name.lower(): value for name, value in response.headers.items()},
+            response.text,
+        )
+
+    def _write(self, method, request, body=None):
+        """Makes a request that modifies a repo through the rate limit scheduler"""
+
+        self._forget()
+
+        return get_scheduler().send(
+            functools.partial(self.__request, method, f"{API_URL}/{request}", body)
+        )
+
+    def _send(self, request, headers):
+        """Makes a get request via the pooled session"""
+
+        return self.__request("GET", f"{API_URL}/{request}", headers=headers)
+
+    def graphql(self, query, variables=None):
+        """Run a GraphQL query, returns the data of the response"""
+
+        # GHES serves GraphQL at /api/graphql instead of under /api/v3
+        url = f"{API_URL.removesuffix('/v3')}/graphql"
+        body = {"query": query, "variables": variables or {}}
+
+        logger.debug("Making GraphQL query to GH API")
+        response = get_scheduler("graphql").send(
+            functools.partial(self.__request, "POST", url, body)
+        )
+
+        if response is None:
+            return {}
+
+        try:
+            return _graphql_data(json.loads(response.text))
+
+        except ValueError:
+            logger.debug("Problem decoding GitHub API response")
+            return {}
+
+    def create_repo(self, description="", private=True):
+        """Comment"""
+
+        if self.cw_repo.owner == self.__get_login():
+            request = "user/repos"
+        else:
+            request = f"orgs/{self.cw_repo.owner}/repos"
+
+        body = {
+            "name": self.cw_repo.repo,
+            "description": description,
+            "private": private,
+            "auto_init": True,
+        }
+
+        response = self._write("POST", request, body)
+
+        if response is None or not response.ok:
+            logger.debug("Could not create the repo")
+            return False
+
+        return True
+
+    def create_dir(
+        self, path, commit_message="Commit via Archctl", content="", branch=None
+    ):
+        """Create directory in repo"""
+
+        request = f"repos/{self.cw_repo.full_name}/contents/{path}"
+
+        body = {"message": commit_message, "content": content}
+
+        if branch is not None:
+            body["branch"] = branch
+
+        response = self._write("PUT", request, body)
+
+        if response is None or not response.ok:
+            logger.debug("Problem creating the directory in the repo")
+            return False
+
+        return True
+
+    def delete_repo(self, confirm=True):
+        """Comment"""
+
+        response = self._write("DELETE", f"repos/{self.cw_repo.full_name}")
+
+        if response is None or not response.ok:
             logger.debug("Could not delete the repo")
             return False
+
+        return True
+
+    def create_pr(self, head, base, title="PR created by Archctl"):
+        """Comment
+        Title
+        Body
+        Base branch where to merge
+        Head branch what to merge
+        """
+
+        request = f"repos/{self.cw_repo.full_name}/pulls"
+
+        body = {"title": title, "head": head, "base": base, "body": ""}
+
+        response = self._write("POST", request, body)
+
+        if response is None or not response.ok:
+            logger.debug("Could not create the PR")
+            return False
+
+        print(json.loads(response.text)["html_url"])
+
+        return True
+
+    def __get_login(self):
+        """Name of the user owning the token"""
+
+        return self._get_request("user").get("login")
+
+
+BACKENDS = {"cli": GHCli, "api": GHApi}
+
+
+def get_gh_client() -> GithubIface:
+    """Build the GitHub controller selected in the user config ('gh_backend'),
+    the ARCHCTL_GH_BACKEND env var takes precedence. Defaults to gh cli"""
+
+    backend = os.environ.get("ARCHCTL_GH_BACKEND") or JSONConfig().get_setting(
+        "gh_backend", "cli"
+    )
+
+    if backend not in BACKENDS:
+        logger.debug(f"Unknown GitHub backend {backend}, falling back to gh cli")
+        backend = "cli"
+
+    return BACKENDS[backend]()
@@ -0,0 +1,336 @@
+"""Search engine that resolves the refs, trees and history of a template repo
+with a handful of batched GraphQL queries instead of one REST call per
+branch and template"""
+import json
+import logging
+
+import archctl.commons as comm
+import archctl.utils as utils
+from archctl.github import GithubIface
+from archctl.template_index import get_index
+
+logger = logging.getLogger(__name__)
+
+# Number of aliased objects requested in a single query
+BATCH_SIZE = 50
+
+# GraphQL connections are capped at 100 nodes per page
+MAX_NODES = 100
+
+# Levels of each tree inspected looking for cookiecutter dirs
+TREE_DEPTH = 3
+
+BRANCH_ORDER = {"field": "ALPHABETICAL", "direction": "ASC"}
+TAG_ORDER = {"field": "TAG_COMMIT_DATE", "direction": "DESC"}
+
+REFS_QUERY = """
+query($owner: String!, $name: String!, $prefix: String!, $first: Int!,
+      $after: String, $order: RefOrder) {
+  repository(owner: $owner, name: $name) {
+    defaultBranchRef { name target { ...commit } }
+    refs(refPrefix: $prefix, first: $first, after: $after, orderBy: $order) {
+      pageInfo { hasNextPage endCursor }
+      nodes { name target { ...commit ... on Tag { target { ...commit } } } }
+    }
+  }
+}
+
+fragment commit on Commit { oid tree { oid } }
+"""
+
+BATCH_QUERY = """
+query($owner: String!, $name: String!) {
+  repository(owner: $owner, name: $name) { %s }
+}
+"""
+
+
+def _commit(target):
+    """Get the commit a ref points to, peeling annotated tags"""
+
+    if not target:
+        return None
+    if "oid" in target:
+        return target
+
+    return _commit(target.get("target"))
+
+
+def _list_refs(cli: GithubIface, prefix, limit, order):
+    """Get the head of the default branch and the name, commit and tree of
+    up to limit refs under the prefix (all of them if limit is None)"""
+
+    default, refs, after = None, [], None
+
+    while limit is None or len(refs) < limit:
+        first = MAX_NODES if limit is None else min(MAX_NODES, limit - len(refs))
+        variables = {
+            "owner": cli.cw_repo.owner,
+            "name": cli.cw_repo.repo,
+            "prefix": prefix,
+            "first": first,
+            "after": after,
+            "order": order,
+        }
+
+        repository = cli.graphql(REFS_QUERY, variables).get("repository") or {}
+
+        if repository.get("defaultBranchRef"):
+            default = _commit(repository["defaultBranchRef"]["target"])
+
+        connection = repository.get("refs") or {}
+        for node in connection.get("nodes", []):
+            commit = _commit(node["target"])
+            if commit is not None:
+                refs.append(
+                    {"name": node["name"], "sha": commit["oid"], "tree": commit["tree"]["oid"]}
+                )
+
+        page = connection.get("pageInfo") or {}
+        if not page.get("hasNextPage"):
+            break
+        after = page["endCursor"]
+
+    return default, refs
+
+
+def _batch(cli: GithubIface, fields: dict) -> dict:
+    """Request the aliased fields of the repository in batches of BATCH_SIZE"""
+
+    results = {}
+    aliases = list(fields)
+    variables = {"owner": cli.cw_repo.owner, "name": cli.cw_repo.repo}
+
+    for i in range(0, len(aliases), BATCH_SIZE):
+        query = " ".join(f"{a}: {fields[a]}" for a in aliases[i:i + BATCH_SIZE])
+        data = cli.graphql(BATCH_QUERY % query, variables)
+        results.update(data.get("repository") or {})
+
+    return results
+
+
+def _entries_fields(depth):
+    """Fields of the entries of a tree, nested depth levels. The entries of the
+    last level have the oid, to follow them in another query"""
+
+    if depth == 1:
+        return "name type oid"
+
+    return f"name type object {{ ... on Tree {{ entries {{ {_entries_fields(depth - 1)} }} }} }}"
+
+
+def _in_template(path):
+    """The path is a cookiecutter dir or is under one"""
+
+    return any(utils.is_cookiecutter_dir(part) for part in path.split("/"))
+
+
+def _flatten(entries, prefix, deeper):
+    """Yield the directories of a nested GraphQL tree, with the same shape and
+    order as the entries of a recursive REST tree. The trees of the last level
+    that may still hold a template are appended to deeper, with their oid"""
+
+    for entry in entries:
+        if entry["type"] != "tree":
+            continue
+
+        path = f"{prefix}{entry['name']}"
+        yield {"path": path, "mode": "040000"}
+
+        if "object" in entry:
+            yield from _flatten((entry["object"] or {}).get("entries", []), f"{path}/", deeper)
+        elif not _in_template(path):
+            deeper.append((f"{path}/", entry["oid"]))
+
+
+def _scan(cli: GithubIface, trees) -> dict:
+    """Get the dirs of each of the trees, by tree SHA, TREE_DEPTH levels at a
+    time. The trees left at the last level are followed in further batched
+    queries, so the trees are scanned whole, as walk_tree does. The trees that
+    couldn't be scanned whole are None"""
+
+    dirs = {tree: [] for tree in trees}
+
+    # Subtrees left to scan: the tree they belong to, their path and oid
+    pending = [(tree, "", tree) for tree in trees]
+    entries = _entries_fields(TREE_DEPTH)
+
+    while pending:
+        fields = {
+            f"t{i}": f'object(oid: "{oid}") {{ ... on Tree {{ entries {{ {entries} }} }} }}'
+            for i, (_, _, oid) in enumerate(pending)
+        }
+        results = _batch(cli, fields)
+
+        deeper = []
+        for i, (tree, prefix, _) in enumerate(pending):
+            if dirs[tree] is None:
+                continue
+            if f"t{i}" not in results:
+                dirs[tree] = None
+                continue
+
+            subtrees = []
+            dirs[tree] += _flatten((results[f"t{i}"] or {}).get("entries", []), prefix, subtrees)
+            deeper += [(tree, path, oid) for path, oid in subtrees]
+
+        pending = [subtree for subtree in deeper if dirs[subtree[0]] is not None]
+
+    return dirs
+
+
+def _templates(cli: GithubIface, trees) -> dict:
+    """Find the templates contained in each of the trees, by tree SHA. Only
+    the trees missing from the template index are requested, and only the
+    ones scanned whole are indexed"""
+
+    index = get_index()
+    templates = {tree: index.get(tree, cli.cw_repo) for tree in trees}
+    missing = [tree for tree, found in templates.items() if found is None]
+
+    for tree, dirs in _scan(cli, missing).items():
+        if dirs is None:
+            templates[tree] = []
+            continue
+
+        templates[tree] = utils.find_templates(cli.cw_repo, dirs)
+        index.put(tree, templates[tree])
+
+    return templates
+
+
+def _history_field(ref, template, first, after=None) -> str:
+    """Field requesting a page of the commits touching the template at ref"""
+
+    args = f"first: {first}"
+    if after is not None:
+        args += f", after: {json.dumps(after)}"
+    if template.template_path is not None:
+        args += f", path: {json.dumps(template.template_path)}"
+
+    return (
+        f'object(oid: "{ref["sha"]}") {{ ... on Commit {{ '
+        f"history({args}) {{ pageInfo {{ hasNextPage endCursor }} nodes {{ oid message }} }} }} }}"
+    )
+
+
+def _histories(cli: GithubIface, inspections, depth) -> list:
+    """Get the last depth commits touching the template of each (ref, template)
+    inspection (all of them if depth isn't positive), as returned by the
+    commits REST endpoint. The histories longer than MAX_NODES are followed
+    page by page, batched with the rest of the histories still to complete"""
+
+    histories = [[] for _ in inspections]
+
+    # Histories left to complete: their index and the cursor of their next page
+    pending = [(i, None) for i in range(len(inspections))]
+
+    while pending:
+        fields = {}
+        for i, after in pending:
+            left = depth - len(histories[i]) if depth > 0 else MAX_NODES
+            fields[f"h{i}"] = _history_field(*inspections[i], min(left, MAX_NODES), after)
+
+        results = _batch(cli, fields)
+
+        next_pending = []
+        for i, _ in pending:
+            history = (results.get(f"h{i}") or {}).get("history") or {}
+            histories[i] += [
+                {"sha": node["oid"], "commit": {"message": node["message"]}}
+                for node in history.get("nodes", [])
+            ]
+
+            page = history.get("pageInfo") or {}
+            if page.get("hasNextPage") and (depth <= 0 or len(histories[i]) < depth):
+                next_pending.append((i, page["endCursor"]))
+
+        pending = next_pending
+
+    return histories
+
+
+def _search_tags(cli: GithubIface, search_resul, repo_tags, templates, template, multiple_templates):
+    """Add the tags to the search_resul, under each of the templates they
+    contain when there are many or one was asked for"""
+
+    if not repo_tags:
+        return search_resul
+
+    if not multiple_templates and template is None:
+        search_resul[cli.cw_repo.repo] = {"tags": [tag["name"] for tag in repo_tags]}
+        return search_resul
+
+    for tag in repo_tags:
+        names = [t.template for t in templates[tag["tree"]]]
+        if template is not None:
+            names = [n for n in names if n == template.template.template]
+        for name in names:
+            search_resul = utils.inspect_tag_template(search_resul, cli, tag, name)
+
+    return search_resul
+
+
+def _branch_inspections(cli: GithubIface, repo_branches, templates, template, multiple_templates):
+    """Every (branch, template) pair whose history has to be fetched"""
+
+    t_repo = cli.cw_repo
+
+    if multiple_templates:
+        templates.update(
+            _templates(cli, {b["tree"] for b in repo_branches} - templates.keys())
+        )
+        return [(branch, t) for branch in repo_branches for t in templates[branch["tree"]]]
+
+    if template is None:
+        template = comm.TemplateVersion(
+            comm.Template(t_repo.repo, t_repo, None), None
+        )
+
+    return [(branch, template.template) for branch in repo_branches]
+
+
+def search(
+    cli: GithubIface, depth, tags, template: comm.TemplateVersion | None = None
+):
+    """Same search as main.search, returning the same search_resul, but
+    resolving every ref, tree and history with batched GraphQL queries"""
+
+    search_resul = {}
+
+    default, repo_branches = _list_refs(cli, "refs/heads/", None, BRANCH_ORDER)
+
+    repo_tags = []
+    if tags:
+        limit = depth if depth > 0 else None
+        repo_tags = _list_refs(cli, "refs/tags/", limit, TAG_ORDER)[1]
+
+    # Look for the templates of the default branch and the tags at once
+    trees = {ref["tree"] for ref in repo_tags}
+    if default is not None:
+        trees.add(default["tree"]["oid"])
+    templates = _templates(cli, trees)
+
+    multiple_templates = (
+        default is not None
+        and len(templates[default["tree"]["oid"]]) > 1
+        and template is None
+    )
+
+    search_resul = _search_tags(
+        cli, search_resul, repo_tags, templates, template, multiple_templates
+    )
+
+    # Only the tags are shown when asked for
+    inspections = [] if tags else _branch_inspections(
+        cli, repo_branches, templates, template, multiple_templates
+    )
+
+    histories = _histories(cli, inspections, depth)
+
+    for (branch, t), commits in zip(inspections, histories):
+        search_resul = utils.add_branch_commits(
+            search_resul, t.template, branch["name"], commits
+        )
+
+    return search_resul
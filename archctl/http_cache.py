@@ -0,0 +1,161 @@
+"""Persistent cache of GitHub API responses"""
+import atexit
+import functools
+import logging
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+
+import archctl.commons as comm
+from archctl.user_config import JSONConfig
+
+logger = logging.getLogger(__name__)
+
+# Default max size of the cache in MB, overridable with 'http_cache_mb'
+MAX_SIZE_MB = 100
+
+SHA = "[0-9a-f]{40}"
+
+# Endpoints whose response can never change, since they are addressed by
+# content (trees, commits and the history reachable from a commit)
+IMMUTABLE = [
+    re.compile(rf"^repos/[^/]+/[^/]+/git/(trees|commits)/{SHA}(\?.*)?$"),
+    re.compile(rf"^repos/[^/]+/[^/]+/commits/{SHA}$"),
+    re.compile(rf"^repos/[^/]+/[^/]+/commits\?(.*&)?sha={SHA}(&.*)?$"),
+]
+
+
+def is_immutable(request):
+    """Returns true if the response of the request is content-addressed"""
+    return any(pattern.match(request) for pattern in IMMUTABLE)
+
+
+@dataclass
+class CacheEntry:
+    body: str
+    etag: str | None
+    last_modified: str | None
+    link: str | None
+
+
+class HTTPCache:
+    """LRU bounded, sqlite backed store of response bodies along with the
+    validators needed to make conditional requests"""
+
+    def __init__(self, path, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+        # Access times of the hits, written along with the next put or on exit
+        # so reads never wait for a transaction
+        self._accessed = {}
+
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body BLOB,
+                etag TEXT,
+                last_modified TEXT,
+                link TEXT,
+                size INTEGER,
+                accessed REAL
+            )"""
+        )
+        self._db.commit()
+
+    def get(self, key) -> CacheEntry | None:
+        """Get the stored response of the key, marking it as recently used"""
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, etag, last_modified, link FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self._accessed[key] = time.time()
+
+        return CacheEntry(zlib.decompress(row[0]).decode(), *row[1:])
+
+    def count(self, hits=0, misses=0, revalidated=0):
+        """Update the stats of the cache, from any thread"""
+
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.revalidated += revalidated
+
+    def put(self, key, body, etag=None, last_modified=None, link=None):
+        """Store a response, evicting the least recently used ones if needed"""
+
+        data = zlib.compress(body.encode())
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, data, etag, last_modified, link, len(data), time.time()),
+            )
+            self.__write_accessed()
+            self.__evict()
+            self._db.commit()
+
+    def flush(self):
+        """Persist the access times of the hits since the last write"""
+
+        with self._lock:
+            self.__write_accessed()
+            self._db.commit()
+
+    def __write_accessed(self):
+        self._db.executemany(
+            "UPDATE responses SET accessed = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self._accessed.items()],
+        )
+        self._accessed = {}
+
+    def __evict(self):
+        """Remove the least recently used responses until under max_size"""
+
+        size = self._db.execute("SELECT TOTAL(size) FROM responses").fetchone()[0]
+        if size <= self.max_size:
+            return
+
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed")
+        evicted = []
+        for key, entry_size in rows.fetchall():
+            if size <= self.max_size:
+                break
+            evicted.append((key,))
+            size -= entry_size
+
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logger.debug(f"Evicted {len(evicted)} responses from the HTTP cache")
+
+    def log_stats(self):
+        logger.debug(
+            f"HTTP cache: {self.hits} hits ({self.revalidated} revalidated), "
+            f"{self.misses} misses"
+        )
+
+
+@functools.cache
+def get_cache() -> HTTPCache:
+    """Process wide HTTP cache, stored under the archctl cache dir"""
+
+    size = JSONConfig().get_setting("http_cache_mb", MAX_SIZE_MB)
+    cache = HTTPCache(comm.CACHE_DIR / "http.sqlite", size * 1024 * 1024)
+    atexit.register(cache.log_stats)
+    atexit.register(cache.flush)
+
+    return cache
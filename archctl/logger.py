@@ -16,9 +16,9 @@ LOG_FORMATS = {
 }
 
 
-def setup_logger(stream_level="DEBUG"):
+def setup_logger(stream_level="DEBUG", stream=None):
     """Configure logger for archctl
-    Set up logging to stdout with given level, defaults to DEBUG.
+    Set up logging to stdout (or the given stream) with given level, defaults to DEBUG.
     """
 
     # Create logger for archctl moduke
@@ -34,7 +34,7 @@ def setup_logger(stream_level="DEBUG"):
     log_level = LOG_LEVELS[stream_level]
 
     # Create a stream handler
-    stream_handler = logging.StreamHandler(stream=sys.stdout)
+    stream_handler = logging.StreamHandler(stream=stream or sys.stdout)
     stream_handler.setLevel(log_level)
     stream_handler.setFormatter(log_formatter)
     logger.addHandler(stream_handler)
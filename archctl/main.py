@@ -3,15 +3,25 @@ Main entry point for the `archctl` command.
 """
 import logging
 import os
+from datetime import datetime
+from functools import partial
+from itertools import islice
+from pathlib import Path
 
 import click
 from cookiecutter.main import cookiecutter as cc
 
 import archctl.commons as comm
 import archctl.git_utils as gu
+import archctl.graphql_search as graphql_search
 from archctl.user_config import JSONConfig
+import archctl.upgrade as upgrader
 import archctl.utils as utils
-from archctl.github import GHCli
+from archctl.github import get_gh_client
+from archctl.mirror import GitMirror
+from archctl.ratelimit import get_scheduler
+from archctl.search_cache import get_watermarks
+from archctl.template_cache import get_template_dir
 import traceback
 
 import subprocess
@@ -62,9 +72,11 @@ def delete(repo: comm.Repo):
     click.echo(f"Repo {repo.full_name} deleted from local config")
 
 
-def create(repo: comm.Repo, template: comm.TemplateVersion, yes, cookies=None):
+def create(
+    repo: comm.Repo, template: comm.TemplateVersion, yes, cookies=None, clone_strategy="shallow"
+):
 
-    cli = GHCli()
+    cli = get_gh_client()
     cli.cw_repo = repo
 
     try:
@@ -75,12 +87,11 @@ def create(repo: comm.Repo, template: comm.TemplateVersion, yes, cookies=None):
 
             # Clone the repo locally
             repo_path = f"{TMP_DIR}{repo.repo}"
-            tmp_repo = gu.clone_repo(repo, repo_path)
+            tmp_repo = gu.clone_repo(repo, repo_path, clone_strategy)
             logger.debug(f"Repo cloned in {repo_path}")
 
-            cc(
-                template=template.template.template_repo.ssh_url,
-                checkout=template.ref,
+            project_dir = cc(
+                template=str(get_template_dir(template)),
                 no_input=yes,
                 overwrite_if_exists=True,
                 output_dir=repo_path,
@@ -89,6 +100,9 @@ def create(repo: comm.Repo, template: comm.TemplateVersion, yes, cookies=None):
             )
             logger.debug(f"Template rendered to {repo_path}")
 
+            # Sparse clones only check out the dir the template renders
+            gu.sparse_checkout_add(tmp_repo, [Path(project_dir).name])
+
             # Push the changes
             gu.push_changes(
                 tmp_repo,
@@ -110,77 +124,28 @@ def create(repo: comm.Repo, template: comm.TemplateVersion, yes, cookies=None):
         os.system("rm -rf /tmp/.archctl/")
 
 
-def upgrade(repos, template: comm.TemplateVersion, yes):
-
-    cli = GHCli()
-
-    for repo in repos:
-
-        # Set the working paths
-        cli.cw_repo = repo
-        tmp_render = f"{TMP_DIR}render-{repo.repo}/"
-        repo_path = f"{TMP_DIR}{repo.repo}/"
-        ignore_path = f"{repo_path}.archignore"
-        cookies_path = f"{TMP_DIR}cookiecutter.yaml"
-
-        try:
-            # Clone the repo
-            git_repo = gu.clone_repo(repo, repo_path)
-            branch = repo.def_ref
-            render_branch = "archctl/upgrade-X"
-
-            # Get the repo ready for the upgrade
-            gu.checkout(git_repo, branch)
-
-            # Get the cookies for that repo
-            if utils.exists(cookies_path):
-                logger.debug("File with Cookies was found in the project's repo")
-                utils.move_file(f"{repo_path}cookiecutter.yaml", cookies_path)
-            else:
-                cookies_path = None
-                logger.debug("No Cookies found, prompting user")
-
-            gu.checkout(git_repo, render_branch)
-            gu.publish_branch(git_repo, render_branch)
-
-            # Render the template
-            cc(
-                template=template.template.template_repo.ssh_url,
-                checkout=template.ref,
-                no_input=yes,
-                overwrite_if_exists=True,
-                output_dir=repo_path,
-                config_file=cookies_path,
-                directory=template.template.template_path,
-            )
-
-            # Check if ignore file exists
-            if not utils.exists(ignore_path):
-                ignore_path = None
-
-            # Move non-ignored files to the repo
-            utils.move_dir(tmp_render, repo_path, ignore_path)
-
-            # Push the changes
-            gu.push_changes(git_repo, f"{repo_path}.", "Project Update via Archctl")
-
-            # Create a PR in the GH repo
-            cli.create_pr(render_branch, branch, "Upgrade No X via Archctl")
-
-            # Clean up the tmp dir
-            os.system("rm -rf /tmp/.archctl/")
-        except Exception as e:
-            traceback.print_exc()
-            logger.error(f"Exception: {str(e)}")
+def upgrade(
+    repos, template: comm.TemplateVersion, yes, jobs=1, pipeline=False, clone_strategy="shallow",
+    cloneless=False,
+):
 
-            os.system("rm -rf /tmp/.archctl/")
+    # Each repo is upgraded in a workspace of its own, jobs of them at a time
+    results = upgrader.run(repos, template, yes, jobs, pipeline, clone_strategy, cloneless)
+    upgrader.print_results(results)
 
 
 def preview(
-    repo: comm.Repo, template: comm.TemplateVersion, show_add, yes, cookies=None
+    repo: comm.Repo,
+    template: comm.TemplateVersion,
+    show_add,
+    yes,
+    cookies=None,
+    clone_strategy="shallow",
+    diff_backend="python",
+    stat=False,
 ):
 
-    cli = GHCli()
+    cli = get_gh_client()
     cli.cw_repo = repo
 
     # Set the working paths
@@ -193,7 +158,7 @@ def preview(
     try:
 
         # Clone the repo
-        git_repo = gu.clone_repo(repo, repo_path)
+        git_repo = gu.clone_repo(repo, repo_path, clone_strategy, branch)
         logger.debug(f"Cloned {repo.repo} in {repo_path}")
 
         # Checkout to the existing branch the user specified the checkout from
@@ -229,8 +194,7 @@ def preview(
 
         # Render the template
         cc(
-            template=template.template.template_repo.ssh_url,
-            checkout=template.ref,
+            template=str(get_template_dir(template)),
             no_input=yes,
             overwrite_if_exists=True,
             output_dir=tmp_render,
@@ -244,12 +208,19 @@ def preview(
 
         # Move non-ignored files to the repo
         tmp_render = str(utils.get_child_folder(tmp_render).absolute())
+        gu.sparse_checkout_add(
+            git_repo, [p.name for p in Path(tmp_render).iterdir() if p.is_dir()]
+        )
         utils.move_dir(tmp_render, repo_path, ignore_path)
 
         gu.commit_changes(git_repo, f"{repo_path}.", "Preview via Archctl")
 
         # Generate diff between current branch (render) and user specified branch
-        utils.print_diffs(gu.diff_branches(git_repo, branch), show_add)
+        if stat:
+            utils.print_stat(gu.diff_stat(git_repo, branch))
+        else:
+            diffs = gu.DIFF_BACKENDS[diff_backend](git_repo, branch, added=show_add)
+            utils.print_diffs(diffs, show_add)
 
         # Clean up the tmp dir
         os.system("rm -rf /tmp/.archctl/")
@@ -260,12 +231,81 @@ def preview(
         os.system("rm -rf /tmp/.archctl/")
 
 
+def _search_tags(cli, depth, tags, template, multiple_templates, jobs):
+    """Get the search_resul of the last depth tags, under each of the
+    templates they contain when there are many or one was asked for"""
+
+    search_resul = {}
+    if not tags:
+        return search_resul
+
+    # Stop listing tags once depth of them have been found
+    repo_tags = [
+        {"name": tag["name"], "sha": tag["commit"]["sha"]}
+        for tag in islice(cli.list_tags(), depth if depth > 0 else None)
+    ]
+
+    if not multiple_templates and template is None:
+        if repo_tags:
+            search_resul[cli.cw_repo.repo] = {"tags": [tag["name"] for tag in repo_tags]}
+        return search_resul
+
+    # Many tags point to the same trees, scan each of them once
+    tag_templates = utils.resolve_templates(cli, [tag["sha"] for tag in repo_tags], jobs)
+    for tag in repo_tags:
+        for tag_temp in tag_templates[tag["sha"]]:
+            if template is None or tag_temp.template == template.template.template:
+                search_resul = utils.inspect_tag_template(search_resul, cli, tag, tag_temp.template)
+
+    return search_resul
+
+
+def _branch_inspections(cli, repo_branches, depth, template, multiple_templates, watermarks):
+    """Inspections of the last depth commits of every branch, of each of its
+    templates when there are many, of the given or the only one otherwise"""
+
+    if not multiple_templates and template is None:
+        t_repo = cli.cw_repo
+        template = comm.TemplateVersion(comm.Template(t_repo.repo, t_repo, None), None)
+
+    return [
+        partial(
+            utils.inspect_branch, {}, cli, branch, depth,
+            template.template if template is not None else None, head, watermarks,
+        )
+        for branch, head in repo_branches.items()
+    ]
+
+
+def _warn_budget(requests):
+    """Every inspection needs at least one request, warn if they won't fit in
+    the rate limit budget, the scheduler will spread them until the reset"""
+
+    remaining, reset = get_scheduler().budget()
+    if remaining is not None and requests > remaining:
+        logger.warning(
+            f"Search needs at least {requests} GitHub API requests but only "
+            f"{remaining} are left until {datetime.fromtimestamp(reset):%H:%M}, "
+            "it will be slowed down to fit the rate limit"
+        )
+
+
 def search(
-    t_repo: comm.Repo, depth, tags, template: comm.TemplateVersion | None = None
+    t_repo: comm.Repo,
+    depth,
+    tags,
+    template: comm.TemplateVersion | None = None,
+    engine="rest",
+    jobs=1,
+    local_mirror=False,
+    output="text",
+    order="stable",
 ):
     """
     Searches for the available templates in the given template_repo and
-    displays them along with depth versions.
+    displays them along with depth versions. With the jsonl output, a record
+    is printed for each tag and commit as soon as its inspection completes,
+    in completion or stable order.
 
     Ex:
         java:
@@ -273,12 +313,30 @@ def search(
             - java@main/fb788fc
     """
 
-    cli = GHCli()
+    cli = get_gh_client()
+    if local_mirror:
+        cli = GitMirror(cli)
     cli.cw_repo = t_repo
 
-    search_resul = {}
+    if engine == "graphql" and not local_mirror:
+        search_resul = graphql_search.search(cli, depth, tags, template)
+        if output == "jsonl":
+            utils.print_records(utils.search_records(search_resul))
+        else:
+            utils.print_search(search_resul, tags)
+        return
 
-    multiple_templates = len(utils.search_templates(cli)) > 1 and template is None
+    # The heads of the branches tell which ones moved since the last search,
+    # and their trees are addressed by commit SHA, which is cached
+    repo_branches = {b["name"]: b["commit"]["sha"] for b in cli.list_branches()}
+    watermarks = get_watermarks(t_repo.full_name)
+    watermarks.prune(repo_branches)
+
+    default_branch = cli.get_default_branch()
+    multiple_templates = (
+        len(utils.search_templates(cli, repo_branches.get(default_branch, default_branch))) > 1
+        and template is None
+    )
 
     """
         {
@@ -289,50 +347,24 @@ def search(
         }
     """
 
-    if tags:
-        repo_tags = [
-            {"name": tag["name"], "sha": tag["commit"]["sha"]}
-            for tag in cli.list_tags()
-        ]
-        if repo_tags:
-            repo_tags = repo_tags[:depth]
-            if multiple_templates:
-                for tag in repo_tags:
-                    if template is None:
-                        search_resul = utils.inspect_tag(search_resul, cli, tag)
-                    else:
-                        search_resul = utils.inspect_tag(
-                            search_resul, cli, tag, template.template
-                        )
-            else:
-                if template is None:
-                    search_resul[t_repo.repo] = {
-                        "tags": [tag["name"] for tag in repo_tags]
-                    }
-                else:
-                    for tag in repo_tags:
-                        search_resul = utils.inspect_tag(
-                            search_resul, cli, tag, template.template
-                        )
-
-    repo_branches = [branch["name"] for branch in cli.list_branches()]
-    if multiple_templates:
-        for branch in repo_branches:
-            if template is None:
-                search_resul = utils.inspect_branch(search_resul, cli, branch, depth)
-            else:
-                search_resul = utils.inspect_branch(
-                    search_resul, cli, branch, depth, template.template
-                )
-
-    else:
-        if template is None:
-            template = comm.TemplateVersion(
-                comm.Template(t_repo.repo, t_repo, None), None
-            )
-        for branch in repo_branches:
-            search_resul = utils.inspect_branch(
-                search_resul, cli, branch, depth, template.template
-            )
+    search_resul = _search_tags(cli, depth, tags, template, multiple_templates, jobs)
+
+    # Each inspection fills its own partial result, they are run concurrently
+    # and merged in this same order so the output is deterministic. Only the
+    # tags are shown when asked for, so the branches aren't inspected then
+    inspections = [] if tags else _branch_inspections(
+        cli, repo_branches, depth, template, multiple_templates, watermarks
+    )
+    _warn_budget(len(inspections))
+
+    if output == "jsonl":
+        # Nothing is kept, the tags resolved upfront go first
+        utils.print_records(utils.search_records(search_resul))
+        for partial_resul in utils.iter_inspections(inspections, jobs, order == "stable"):
+            utils.print_records(utils.search_records(partial_resul))
+        return
+
+    for partial_resul in utils.iter_inspections(inspections, jobs):
+        search_resul = utils.merge_search(search_resul, partial_resul)
 
     utils.print_search(search_resul, tags)
@@ -0,0 +1,197 @@
+"""Local bare mirror of a repo, answering the read requests of the search with
+git plumbing instead of the GitHub API"""
+import logging
+import threading
+
+from git.exc import GitCommandError
+from git.repo import Repo
+
+import archctl.commons as comm
+from archctl.github import PER_PAGE, GithubIface
+
+logger = logging.getLogger(__name__)
+
+# Only branches and tags are mirrored, GitHub also advertises refs/pull/*
+REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+# Repos already fetched in this process
+_synced = set()
+_sync_lock = threading.Lock()
+
+
+class GitMirror(GithubIface):
+    """GitHub controller that reads branches, tags, trees and history from a
+    bare mirror of the repo kept under the archctl cache dir, fetched once per
+    process. Anything else is delegated to the remote controller"""
+
+    def __init__(self, remote: GithubIface):
+        self.remote = remote
+        self._repo = None
+
+    @property
+    def cw_repo(self):
+        return self.remote.cw_repo
+
+    @cw_repo.setter
+    def cw_repo(self, value):
+        self.remote.cw_repo = value
+        self._repo = None
+
+    @property
+    def repo(self) -> Repo:
+        """The mirror of the current working repo, created or fetched on first use"""
+
+        if self._repo is None:
+            self._repo = self.__sync(self.cw_repo)
+
+        return self._repo
+
+    def __sync(self, repo: comm.Repo) -> Repo:
+        path = comm.CACHE_DIR / "mirrors" / repo.owner / f"{repo.repo}.git"
+
+        with _sync_lock:
+            if path.exists():
+                mirror = Repo(path)
+            else:
+                logger.debug(f"Creating the mirror of {repo.full_name} in {path}")
+                mirror = Repo.init(path, bare=True, mkdir=True)
+                mirror.create_remote("origin", repo.ssh_url)
+                mirror.git.config("--unset-all", "remote.origin.fetch")
+                for refspec in REFSPECS:
+                    mirror.git.config("--add", "remote.origin.fetch", refspec)
+
+            if path not in _synced:
+                logger.debug(f"Fetching {repo.full_name} into its mirror")
+                mirror.git.fetch("--prune", "--prune-tags", "--quiet", "origin")
+
+                # Follow the default branch of the remote
+                head = mirror.git.ls_remote("--symref", "origin", "HEAD").split("\n")[0]
+                if head.startswith("ref: "):
+                    mirror.git.symbolic_ref("HEAD", head[5:].split("\t")[0])
+
+                _synced.add(path)
+
+        return mirror
+
+    def __rev_parse(self, rev):
+        try:
+            return self.repo.git.rev_parse("--verify", "--quiet", rev)
+        except GitCommandError:
+            return None
+
+    def __commit(self, sha):
+        tree, message = self.repo.git.show("-s", "--format=%T%x00%B", sha).split("\0", 1)
+        return {"sha": sha, "commit": {"message": message, "tree": {"sha": tree}}}
+
+    def __refs(self, prefix, sort):
+        """Name and commit of the refs under the prefix, peeling annotated tags"""
+
+        output = self.repo.git.for_each_ref(
+            f"--sort={sort}",
+            "--format=%(refname:lstrip=2)%00%(objectname)%00%(*objectname)",
+            prefix,
+        )
+
+        for line in filter(None, output.split("\n")):
+            name, sha, peeled = line.split("\0")
+            yield {"name": name, "commit": {"sha": peeled or sha}}
+
+    def get_repo_info(self):
+        return self.remote.get_repo_info()
+
+    def get_default_branch(self):
+        return self.repo.git.symbolic_ref("--short", "HEAD")
+
+    def get_branch_info(self, branch):
+        sha = self.__rev_parse(f"refs/heads/{branch}^{{commit}}")
+        if sha is None:
+            return {}
+
+        return {"name": branch, "commit": self.__commit(sha)}
+
+    def list_branches(self):
+        return self.__refs("refs/heads", "refname")
+
+    def branch_exists(self, branch):
+        return self.__rev_parse(f"refs/heads/{branch}") is not None
+
+    def get_commits(self, path=None, sha=None, per_page=PER_PAGE):
+        """Lazily iterate over the commits of the repo, newest first. The log is
+        streamed, so stopping early doesn't walk the whole history"""
+
+        args = ["--format=%H%x00%T%x00%B%x1e", sha or "HEAD", "--"]
+        if path is not None:
+            args.append(path)
+
+        process = self.repo.git.log(*args, as_process=True)
+        try:
+            record = b""
+            for chunk in iter(lambda: process.stdout.read(65536), b""):
+                record += chunk
+                *commits, record = record.split(b"\x1e")
+                for commit in commits:
+                    sha, tree, message = commit.lstrip(b"\n").decode().split("\0", 2)
+                    yield {"sha": sha, "commit": {"message": message, "tree": {"sha": tree}}}
+        finally:
+            process.proc.kill()
+            process.proc.wait()
+
+    def list_tags(self):
+        return self.__refs("refs/tags", "-creatordate")
+
+    def get_tree_sha(self, ref=None):
+        return self.__rev_parse(f"{ref or 'HEAD'}^{{tree}}")
+
+    def get_tree(self, ref=None, recursive="0"):
+        """Same shape as the GitHub trees endpoint, never truncated"""
+
+        sha = self.get_tree_sha(ref)
+        if sha is None:
+            return {}
+
+        args = ["-r", "-t"] if recursive not in (None, False, 0, "0", "false") else []
+        output = self.repo.git.ls_tree("-z", *args, sha)
+
+        tree = []
+        for line in filter(None, output.split("\0")):
+            info, path = line.split("\t", 1)
+            mode, type, object_sha = info.split(" ")
+            tree.append({"path": path, "mode": mode, "type": type, "sha": object_sha})
+
+        return {"sha": sha, "tree": tree, "truncated": False}
+
+    def get_file(self, path, ref=None):
+        sha = self.__rev_parse(f"{ref or 'HEAD'}:{path}")
+        if sha is None or self.repo.git.cat_file("-t", sha) != "blob":
+            return None
+
+        return self.repo.git.cat_file("blob", sha, stdout_as_string=False)
+
+    def graphql(self, query, variables=None):
+        return self.remote.graphql(query, variables)
+
+    def create_repo(self, description="", private=False):
+        return self.remote.create_repo(description, private)
+
+    def create_dir(
+        self, path, commit_message="Commit via Archctl", content="", branch=None
+    ):
+        return self.remote.create_dir(path, commit_message, content, branch)
+
+    def delete_repo(self, confirm=True):
+        return self.remote.delete_repo(confirm)
+
+    def create_pr(self, head, base, title="PR created by Archctl"):
+        return self.remote.create_pr(head, base, title)
+
+    def create_blob(self, content):
+        return self.remote.create_blob(content)
+
+    def create_tree(self, entries, base_tree=None):
+        return self.remote.create_tree(entries, base_tree)
+
+    def create_commit(self, message, tree, parents):
+        return self.remote.create_commit(message, tree, parents)
+
+    def create_ref(self, branch, sha):
+        return self.remote.create_ref(branch, sha)
@@ -0,0 +1,192 @@
+"""Scheduling of the requests made to the GitHub API within its rate limits"""
+import functools
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+
+import click
+
+from archctl.user_config import JSONConfig
+
+logger = logging.getLogger(__name__)
+
+# Sustained requests per second and burst allowed by the token bucket
+RATE = 15
+BURST = 30
+
+# Max requests in flight, halved on secondary rate limits
+MAX_CONCURRENCY = 16
+
+# Below this many remaining requests, the rest are spread until the reset
+RESERVE = 100
+
+# Retries of a rate limited request and base of their exponential backoff
+MAX_RETRIES = 5
+BACKOFF = 2
+
+# Default max seconds to wait for the limits, overridable with 'rate_limit_max_wait'
+MAX_WAIT = 900
+
+
+class RateLimitExceeded(click.ClickException):
+    """The GitHub API rate limit can't be waited out"""
+
+
+class Scheduler:
+    """Paces the requests to a GitHub API resource (core, graphql...) with a
+    token bucket, tracking the budget left from the X-RateLimit-* headers.
+    Concurrency is reduced on secondary rate limits and slowly restored"""
+
+    def __init__(self, rate=RATE, burst=BURST, concurrency=MAX_CONCURRENCY, max_wait=MAX_WAIT):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = concurrency
+        self.max_wait = max_wait
+
+        self.concurrency = concurrency
+        self.remaining = None
+        self.reset = None
+
+        self._cond = threading.Condition()
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._in_flight = 0
+        self._paused_until = 0
+        self._successes = 0
+
+    def budget(self):
+        """Requests left and epoch time at which the budget resets, both None
+        until a response has been seen"""
+        return self.remaining, self.reset
+
+    def __current_rate(self):
+        """Requests per second allowed, spreading the budget when it runs low"""
+
+        if self.remaining is None or self.remaining >= RESERVE:
+            return self.rate
+
+        return min(self.rate, max(self.remaining, 1) / max(self.reset - time.time(), 1))
+
+    def __wait_time(self):
+        """Seconds to wait before the next request can be sent, None if it has
+        to wait for another request to finish"""
+
+        now = time.monotonic()
+        rate = self.__current_rate()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        if self.remaining == 0 and self.reset > time.time():
+            return self.reset - time.time()
+
+        if self._in_flight >= self.concurrency:
+            return None
+
+        if self._tokens < 1:
+            return (1 - self._tokens) / rate
+
+        return 0
+
+    def acquire(self):
+        """Block until a request can be sent"""
+
+        with self._cond:
+            while (wait := self.__wait_time()) != 0:
+                if wait is not None and wait > self.max_wait:
+                    raise RateLimitExceeded(
+                        "GitHub API rate limit exhausted until "
+                        f"{datetime.fromtimestamp(time.time() + wait):%H:%M:%S}"
+                    )
+                self._cond.wait(wait)
+
+            self._tokens -= 1
+            self._in_flight += 1
+            if self.remaining:
+                self.remaining -= 1
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        """Hold every request for the given seconds"""
+
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update(self, response, attempt=0):
+        """Update the budget with the headers of the response. Returns the
+        seconds to wait before retrying it if it was rate limited, else None"""
+
+        if response is None:
+            return None
+
+        headers = response.headers
+
+        with self._cond:
+            if "x-ratelimit-remaining" in headers:
+                self.remaining = int(headers["x-ratelimit-remaining"])
+                self.reset = int(headers.get("x-ratelimit-reset", time.time()))
+
+            if response.status not in (403, 429):
+                # Give back one slot after each window of successful requests
+                self._successes += 1
+                if self._successes >= self.concurrency:
+                    self._successes = 0
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                return None
+
+            secondary = "secondary rate limit" in response.text.lower()
+
+            if "retry-after" in headers:
+                wait = int(headers["retry-after"])
+            elif self.remaining == 0:
+                wait = self.reset - time.time() + 1
+            elif secondary:
+                wait = BACKOFF ** (attempt + 1)
+            else:
+                return None  # Forbidden for other reasons
+
+            if secondary or "retry-after" in headers:
+                self._successes = 0
+                self.concurrency = max(1, self.concurrency // 2)
+                logger.debug(f"Secondary rate limit, concurrency down to {self.concurrency}")
+
+        # Jitter so concurrent requests don't retry all at once
+        return wait + random.uniform(0, BACKOFF)
+
+    def send(self, send):
+        """Send a request (send returns a github.Response) through the
+        scheduler, waiting and retrying it while it's rate limited"""
+
+        for attempt in range(MAX_RETRIES + 1):
+            self.acquire()
+            try:
+                response = send()
+            finally:
+                self.release()
+
+            wait = self.update(response, attempt)
+            if wait is None:
+                return response
+
+            if attempt == MAX_RETRIES or wait > self.max_wait:
+                break
+
+            logger.info(f"GitHub API rate limit hit, retrying in {wait:.0f}s")
+            self.pause(wait)
+
+        raise RateLimitExceeded("GitHub API rate limit exceeded, try again later")
+
+
+@functools.cache
+def get_scheduler(resource="core") -> Scheduler:
+    """Process wide scheduler of the given GitHub API resource"""
+
+    return Scheduler(max_wait=JSONConfig().get_setting("rate_limit_max_wait", MAX_WAIT))
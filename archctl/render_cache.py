@@ -0,0 +1,85 @@
+"""Renders of template versions, shared by every project with the same cookies"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from cookiecutter.config import get_user_config
+
+import archctl.commons as comm
+from archctl.user_config import JSONConfig
+
+logger = logging.getLogger(__name__)
+
+# Max size of the renders, the least recently used ones are evicted first
+MAX_SIZE_MB = 1000
+
+# Renders used by this process, never evicted while it runs
+_used = set()
+
+
+def render_key(template_sha, template_path, config_file=None) -> str:
+    """Hash of everything a render without input depends on: the commit of the
+    template, its path in the repo and the default context of the cookies.
+    Only the context is hashed, so the formatting of the cookies doesn't matter"""
+
+    context = get_user_config(config_file)["default_context"]
+    key = json.dumps([template_sha, template_path, context], sort_keys=True, default=str)
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def get_render(key, render) -> Path:
+    """Get the project dir rendered for the key, calling render(output_dir)
+    only the first time. Renders are kept by key under the archctl cache dir,
+    up to render_cache_mb of them"""
+
+    cache_dir = comm.CACHE_DIR / "renders"
+    rendered = cache_dir / key
+
+    if not rendered.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(dir=cache_dir, prefix=".render-"))
+
+        try:
+            render(tmp_dir)
+
+            # Another process may have got there first, either render is the same
+            try:
+                tmp_dir.rename(rendered)
+            except OSError:
+                pass
+
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        _used.add(rendered)
+        comm.touch_cache_entry(rendered)
+        size = JSONConfig().get_setting("render_cache_mb", MAX_SIZE_MB)
+        comm.evict_cache_dir(cache_dir, size * 1024 * 1024, keep=_used)
+
+    else:
+        logger.debug(f"Render {key} found in the cache")
+        _used.add(rendered)
+        comm.touch_cache_entry(rendered)
+
+    return next(rendered.iterdir())
+
+
+def link_or_copy(src, dst):
+    """Hardlink the file, copying it if it's in another filesystem"""
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def link_tree(src, dst):
+    """Replicate the render at src in dst, without touching the cached files
+    when the ones in dst are moved or replaced"""
+
+    shutil.copytree(src, dst, copy_function=link_or_copy, symlinks=True)
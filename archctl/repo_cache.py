@@ -0,0 +1,104 @@
+"""Cache of bare mirrors of the registered project repos, checked out in a
+throwaway worktree for each operation instead of cloning them every time"""
+import functools
+import logging
+import threading
+from pathlib import Path
+
+from git.exc import GitCommandError
+from git.repo import Repo
+
+import archctl.commons as comm
+from archctl.user_config import JSONConfig
+
+logger = logging.getLogger(__name__)
+
+# Max size of the mirrors, the least recently used ones are evicted first
+MAX_SIZE_MB = 2000
+
+
+class RepoCache:
+    """Bare mirrors of project repos with the branches of the remote under
+    refs/remotes/origin, like a regular clone. Each mirror is fetched once per
+    process and every operation gets a worktree of its own out of it"""
+
+    def __init__(self, path: Path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._fetched = set()
+        self._lock = threading.Lock()
+        self._locks = {}
+
+        # Mirrors used by this process, never evicted while it runs as other
+        # jobs may have a worktree out of them
+        self._used = set()
+
+    def __mirror(self, repo: comm.Repo) -> Repo:
+        path = self.path / repo.owner / f"{repo.repo}.git"
+
+        with self._lock:
+            lock = self._locks.setdefault(path, threading.Lock())
+
+        with lock:
+            if path.exists():
+                mirror = Repo(path)
+            else:
+                logger.debug(f"Creating the mirror of {repo.full_name} in {path}")
+                mirror = Repo.init(path, bare=True, mkdir=True)
+                mirror.create_remote("origin", repo.ssh_url)
+
+            if path not in self._fetched:
+                logger.debug(f"Fetching {repo.full_name} into its mirror")
+                mirror.git.fetch("--prune", "--quiet", "origin")
+                self.__housekeeping(mirror)
+                self._fetched.add(path)
+                comm.touch_cache_entry(path, measure=True)
+            else:
+                comm.touch_cache_entry(path)
+
+            self._used.add(path)
+
+        return mirror
+
+    def __housekeeping(self, mirror: Repo):
+        """Forget the worktrees that were deleted and the branches they left"""
+
+        mirror.git.worktree("prune")
+
+        heads = mirror.git.for_each_ref("--format=%(refname:short)", "refs/heads")
+        for head in filter(None, heads.split("\n")):
+            try:
+                mirror.git.branch("-D", head)
+            except GitCommandError:
+                pass  # Checked out in a worktree still in use
+
+    def worktree(self, repo: comm.Repo, branch, path) -> Repo:
+        """Check out the branch of the repo in a new worktree at path. The
+        branch is reset to the one in the remote, as it was fetched"""
+
+        mirror = self.__mirror(repo)
+        mirror.git.worktree("add", "-f", "-B", branch, str(path), f"origin/{branch}")
+        self.evict()
+
+        return Repo(path)
+
+    def evict(self):
+        """Remove the least recently used mirrors until under max_size"""
+
+        comm.evict_cache_dir(self.path, self.max_size, keep=self._used, pattern="*/*.git")
+
+    def is_registered(self, repo: comm.Repo):
+        """Only the project repos registered in the user config are cached"""
+
+        try:
+            return repo.full_name in {r.full_name for r in JSONConfig().project_repos()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+
+@functools.cache
+def get_repo_cache() -> RepoCache:
+    """Process wide cache of project repos, stored under the archctl cache dir"""
+
+    size = JSONConfig().get_setting("repo_cache_mb", MAX_SIZE_MB)
+    return RepoCache(comm.CACHE_DIR / "repos", size * 1024 * 1024)
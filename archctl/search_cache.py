@@ -0,0 +1,99 @@
+"""Watermarks of the refs of a template repo, to search only what changed
+since the last run"""
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+import archctl.commons as comm
+
+logger = logging.getLogger(__name__)
+
+
+def covers(depth, other):
+    """Returns true if a search of depth commits finds the ones of other,
+    depth -1 means all of them"""
+
+    return depth <= 0 or 0 < other <= depth
+
+
+class Watermarks:
+    """Last head seen for each branch of a template repo, with the commits
+    found for each template up to the depth of that search. Only valid as
+    long as the head doesn't move, then it tells where to stop fetching"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._refs = None
+        self._lock = threading.Lock()
+
+    def __load(self):
+        if self._refs is None:
+            try:
+                self._refs = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                self._refs = {}
+
+    def get(self, ref, template: str) -> tuple[str, int, list] | None:
+        """Get the head, depth and commits of the template last seen in the
+        ref, None if it was never searched"""
+
+        with self._lock:
+            self.__load()
+            watermark = self._refs.get(ref)
+
+        if watermark is None or template not in watermark["commits"]:
+            return None
+
+        return watermark["head"], watermark["depth"], watermark["commits"][template]
+
+    def put(self, ref, head, depth, template: str, commits: list):
+        """Save the commits of the template found in the ref at head"""
+
+        with self._lock:
+            self.__load()
+            watermark = self._refs.get(ref)
+
+            if watermark is not None and watermark["head"] == head:
+                # A shallower search of the same head doesn't replace a deeper one
+                if template in watermark["commits"] and covers(watermark["depth"], depth):
+                    return
+                if watermark["depth"] == depth:
+                    watermark["commits"][template] = commits
+                    return
+
+            self._refs[ref] = {"head": head, "depth": depth, "commits": {template: commits}}
+
+    def prune(self, refs):
+        """Forget the refs that don't exist anymore"""
+
+        with self._lock:
+            self.__load()
+            self._refs = {ref: w for ref, w in self._refs.items() if ref in refs}
+
+    def save(self):
+        with self._lock:
+            if self._refs is None:
+                return
+
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+                tmp_path.write_text(json.dumps(self._refs))
+                tmp_path.replace(self.path)
+
+            except OSError:
+                logger.debug(f"Could not persist the watermarks in {self.path}")
+
+
+@functools.cache
+def get_watermarks(full_name: str) -> Watermarks:
+    """Watermarks of the template repo, saved under the archctl cache dir on exit"""
+
+    watermarks = Watermarks(comm.CACHE_DIR / "search" / f"{full_name}.json")
+    atexit.register(watermarks.save)
+
+    return watermarks
@@ -0,0 +1,92 @@
+"""Checkouts of template versions, shared by every render of the same commit"""
+import logging
+import shutil
+import tempfile
+from pathlib import Path
+
+from git.cmd import Git
+from git.exc import GitCommandError
+from git.repo import Repo
+
+import archctl.commons as comm
+from archctl.github import sha_pattern
+from archctl.user_config import JSONConfig
+
+logger = logging.getLogger(__name__)
+
+# Max size of the checkouts, the least recently used ones are evicted first
+MAX_SIZE_MB = 1000
+
+# Checkouts used by this process, never evicted while it runs
+_used = set()
+
+
+def resolve_ref(url, ref=None) -> str | None:
+    """Get the SHA of the commit a branch or tag of the remote points to, None
+    if the remote has no such ref (it may be a commit SHA)"""
+
+    ref = ref or "HEAD"
+
+    try:
+        output = Git().ls_remote(url, ref, f"{ref}^{{}}")
+    except GitCommandError:
+        return None
+
+    refs = dict(reversed(line.split("\t")) for line in output.split("\n") if line)
+
+    # Same precedence as git, annotated tags are peeled to their commit
+    for name in (ref, f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}", f"refs/heads/{ref}"):
+        if name in refs:
+            return refs[name]
+
+    return None
+
+
+def get_template_dir(template: comm.TemplateVersion) -> Path:
+    """Get a checkout of the template repo at the commit of the template
+    version, cloning it only the first time that commit is rendered. The
+    checkouts are kept by commit SHA under the archctl cache dir, up to
+    template_cache_mb of them"""
+
+    url = template.template.template_repo.ssh_url
+    cache_dir = comm.CACHE_DIR / "templates"
+
+    # Commit SHAs, as printed by search, are their own key
+    if template.ref is not None and sha_pattern.fullmatch(template.ref):
+        sha = template.ref
+    else:
+        sha = resolve_ref(url, template.ref)
+
+    if sha is not None and (cache_dir / sha).exists():
+        logger.debug(f"Template {url}@{template.ref} found in the cache: {sha}")
+        _used.add(cache_dir / sha)
+        comm.touch_cache_entry(cache_dir / sha)
+        return cache_dir / sha
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_dir = Path(tempfile.mkdtemp(dir=cache_dir, prefix=".checkout-"))
+
+    try:
+        logger.debug(f"Cloning template {url}@{template.ref}")
+        repo = Repo.clone_from(url, tmp_dir, no_checkout=True)
+
+        if sha is None:
+            sha = repo.git.rev_parse(f"{template.ref or 'HEAD'}^{{commit}}")
+        repo.git.checkout(sha)
+        shutil.rmtree(tmp_dir / ".git")
+
+        # Another process may have got there first, either checkout is the same
+        try:
+            tmp_dir.rename(cache_dir / sha)
+        except OSError:
+            pass
+
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _used.add(cache_dir / sha)
+    comm.touch_cache_entry(cache_dir / sha)
+    size = JSONConfig().get_setting("template_cache_mb", MAX_SIZE_MB)
+    comm.evict_cache_dir(cache_dir, size * 1024 * 1024, keep=_used)
+
+    return cache_dir / sha
@@ -0,0 +1,94 @@
+"""Index of the cookiecutter templates found in each git tree"""
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+import archctl.commons as comm
+
+logger = logging.getLogger(__name__)
+
+# Max number of trees kept in the index, the oldest ones are dropped first
+MAX_TREES = 10000
+
+
+class TemplateIndex:
+    """Maps the SHA of a tree to the paths of the templates under it. Trees
+    are content-addressed, so their templates never change and the index can
+    be shared by every ref, repo and run that comes across the same tree"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._trees = None
+        self._new = {}
+        self._lock = threading.Lock()
+
+    def __load(self):
+        if self._trees is None:
+            try:
+                self._trees = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                self._trees = {}
+
+    def get(self, tree_sha, repo: comm.Repo) -> list[comm.Template] | None:
+        """Get the templates of the tree, None if it hasn't been indexed yet"""
+
+        with self._lock:
+            self.__load()
+            paths = self._trees.get(tree_sha)
+
+        if paths is None:
+            return None
+
+        # None is the path of a template at the root of the repo
+        return [
+            comm.Template(Path(p).name if p else repo.repo, repo, p) for p in paths
+        ]
+
+    def put(self, tree_sha, templates: list[comm.Template]):
+        """Index the templates found in the tree"""
+
+        with self._lock:
+            self.__load()
+            paths = [t.template_path for t in templates]
+            self._trees[tree_sha] = paths
+            self._new[tree_sha] = paths
+
+    def save(self):
+        """Persist the new trees, merging them with the ones other processes
+        may have saved in the meantime"""
+
+        with self._lock:
+            if not self._new:
+                return
+
+            try:
+                trees = json.loads(self.path.read_text())
+            except (OSError, ValueError):
+                trees = {}
+
+            trees.update(self._new)
+            trees = dict(list(trees.items())[-MAX_TREES:])
+
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+                tmp_path.write_text(json.dumps(trees))
+                tmp_path.replace(self.path)
+                self._new = {}
+
+            except OSError:
+                logger.debug("Could not persist the template index")
+
+
+@functools.cache
+def get_index() -> TemplateIndex:
+    """Process wide template index, saved under the archctl cache dir on exit"""
+
+    index = TemplateIndex(comm.CACHE_DIR / "templates.json")
+    atexit.register(index.save)
+
+    return index
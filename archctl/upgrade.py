@@ -0,0 +1,432 @@
+"""Upgrade engine, renders a template version into many project repos
+concurrently, each one in its own workspace"""
+import logging
+import posixpath
+import queue
+import shutil
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+
+import click
+from cookiecutter.main import cookiecutter as cc
+from git.repo import Repo
+
+import archctl.commons as comm
+import archctl.git_utils as gu
+import archctl.utils as utils
+from archctl.github import GithubIface, get_gh_client
+from archctl.render_cache import get_render, link_tree, render_key
+from archctl.template_cache import get_template_dir
+
+logger = logging.getLogger(__name__)
+
+RENDER_BRANCH = "archctl/upgrade-X"
+
+
+@dataclass
+class UpgradeResult:
+    repo: str
+    status: str
+    detail: str = ""
+
+
+@dataclass
+class Job:
+    """State of the upgrade of a repo, handed from one stage to the next"""
+
+    repo: comm.Repo
+    template: comm.TemplateVersion
+    template_dir: Path
+    yes: bool
+    workspace: Path
+    strategy: str = "shallow"
+    cli: GithubIface | None = None
+    git_repo: Repo | None = None
+    branch: str | None = None
+    cookies: str | None = None
+    project_dir: str | None = None
+    base: str | None = None
+    base_tree: str | None = None
+    changes: list | None = None
+    result: UpgradeResult | None = None
+
+    @property
+    def repo_path(self):
+        return self.workspace / "repo"
+
+
+def clone(job: Job):
+    """Clone the repo and get it ready for the upgrade"""
+
+    job.cli = get_gh_client()
+    job.cli.cw_repo = job.repo
+
+    job.branch = job.repo.def_ref or job.cli.get_default_branch()
+    job.git_repo = gu.clone_repo(job.repo, job.repo_path, job.strategy, job.branch)
+    gu.checkout(job.git_repo, job.branch)
+    logger.debug(f"Cloned {job.repo.full_name}@{job.branch} in {job.repo_path}")
+
+
+def extract_cookies(job: Job):
+    """Get the cookies for that repo, a copy so it stays in the repo"""
+
+    cookies_path = job.repo_path / "cookiecutter.yaml"
+
+    if cookies_path.exists():
+        logger.debug(f"File with Cookies was found in {job.repo.full_name}")
+        job.cookies = str(shutil.copy(cookies_path, job.workspace / "cookiecutter.yaml"))
+    else:
+        logger.debug("No Cookies found, prompting user")
+
+    gu.checkout(job.git_repo, RENDER_BRANCH)
+
+
+def render(job: Job):
+    """Render the template for the repo. Renders without input only depend on
+    the template and the cookies, so repos sharing them share a single render"""
+
+    def cookiecutter(output_dir):
+        return cc(
+            template=str(job.template_dir),
+            no_input=job.yes,
+            overwrite_if_exists=True,
+            output_dir=str(output_dir),
+            config_file=job.cookies,
+            directory=job.template.template.template_path,
+        )
+
+    render_dir = job.workspace / "render"
+
+    if not job.yes:
+        job.project_dir = cookiecutter(render_dir)
+        return
+
+    # The checkouts of the template are named after their commit
+    key = render_key(job.template_dir.name, job.template.template.template_path, job.cookies)
+    rendered = get_render(key, cookiecutter)
+
+    job.project_dir = str(render_dir / rendered.name)
+    link_tree(rendered, job.project_dir)
+
+
+def merge(job: Job):
+    """Move the non-ignored files of the render to the repo"""
+
+    ignore_path = job.repo_path / ".archignore"
+    ignore = str(ignore_path) if ignore_path.exists() else None
+
+    # Sparse clones only check out the dirs the template renders
+    rendered = [path.name for path in Path(job.project_dir).iterdir() if path.is_dir()]
+    gu.sparse_checkout_add(job.git_repo, rendered)
+
+    utils.move_dir(job.project_dir, job.repo_path, ignore)
+
+
+def push(job: Job):
+    """Commit and push the upgrade, unless the render left the repo as it was"""
+
+    if gu.stage_unchanged(job.git_repo, f"{job.repo_path}/.", f"origin/{job.branch}"):
+        job.result = UpgradeResult(job.repo.full_name, "up to date")
+        return
+
+    gu.commit_changes(job.git_repo, f"{job.repo_path}/.", "Project Update via Archctl")
+    gu.publish_branch(job.git_repo, RENDER_BRANCH)
+
+
+def open_pr(job: Job):
+    if not job.cli.create_pr(RENDER_BRANCH, job.branch, "Upgrade No X via Archctl"):
+        raise RuntimeError("Could not create the PR")
+
+    job.result = UpgradeResult(job.repo.full_name, "upgraded")
+
+
+def fetch_base(job: Job):
+    """Get the base branch, the cookies and the ignore file of the repo over
+    the API, instead of cloning it"""
+
+    job.cli = get_gh_client()
+    job.cli.cw_repo = job.repo
+
+    job.branch = job.repo.def_ref or job.cli.get_default_branch()
+    branch = job.cli.get_branch_info(job.branch)
+    if not branch:
+        raise RuntimeError(f"Could not get the branch {job.branch}")
+
+    job.base = branch["commit"]["sha"]
+    job.base_tree = branch["commit"]["commit"]["tree"]["sha"]
+
+    for name in ("cookiecutter.yaml", ".archignore"):
+        content = job.cli.get_file(name, job.base)
+        if content is not None:
+            (job.workspace / name).write_bytes(content)
+
+    if (job.workspace / "cookiecutter.yaml").exists():
+        logger.debug(f"File with Cookies was found in {job.repo.full_name}")
+        job.cookies = str(job.workspace / "cookiecutter.yaml")
+    else:
+        logger.debug("No Cookies found, prompting user")
+
+
+def base_blobs(cli: GithubIface, tree_sha, paths):
+    """Mode and SHA of the blobs of the tree, by path. The recursive tree is
+    requested at once, if GitHub truncates it only the subtrees leading to the
+    given paths are listed"""
+
+    tree = cli.get_tree(tree_sha, "1")
+    if not tree:
+        raise RuntimeError(f"Could not get the tree {tree_sha}")
+
+    if not tree.get("truncated"):
+        return {e["path"]: (e["mode"], e["sha"]) for e in tree["tree"] if e["type"] == "blob"}
+
+    dirs = set()
+    for path in paths:
+        while path:
+            path = posixpath.dirname(path)
+            dirs.add(path)
+
+    # Parents sort before their children, so their trees are known by then
+    trees = {"": tree_sha}
+    blobs = {}
+    for dir in sorted(dirs):
+        if dir not in trees:
+            continue
+
+        for entry in cli.get_tree(trees[dir]).get("tree", []):
+            path = posixpath.join(dir, entry["path"])
+            if entry["type"] == "tree":
+                trees[path] = entry["sha"]
+            elif entry["type"] == "blob":
+                blobs[path] = (entry["mode"], entry["sha"])
+
+    return blobs
+
+
+def diff_render(job: Job):
+    """Find the non-ignored files of the render that differ from the ones in
+    the base branch, the only ones that have to be uploaded"""
+
+    project_dir = Path(job.project_dir)
+    ignore_path = job.workspace / ".archignore"
+    parser = utils.get_ignore_parser(ignore_path, project_dir) if ignore_path.exists() else None
+
+    files = {}
+    for file in sorted(project_dir.rglob("*")):
+        if file.is_dir() and not file.is_symlink():
+            continue
+        if parser is not None and parser.match(file):
+            continue
+        files[file.relative_to(project_dir).as_posix()] = file
+
+    blobs = base_blobs(job.cli, job.base_tree, files)
+
+    job.changes = []
+    for path, file in files.items():
+        mode, content = gu.blob_entry(file)
+        if blobs.get(path) != (mode, gu.blob_sha(content)):
+            job.changes.append((path, mode, file))
+
+    if not job.changes:
+        job.result = UpgradeResult(job.repo.full_name, "up to date")
+
+
+def commit_tree(job: Job):
+    """Upload the changed files and commit them on top of the base branch,
+    creating the branch straight in the remote"""
+
+    blobs = {}
+    entries = []
+    for path, mode, file in job.changes:
+        content = gu.blob_entry(file)[1]
+        sha = gu.blob_sha(content)
+
+        # Files with the same content are the same blob
+        if sha not in blobs:
+            blobs[sha] = job.cli.create_blob(content)
+            if blobs[sha] is None:
+                raise RuntimeError(f"Could not upload {path}")
+
+        entries.append({"path": path, "mode": mode, "type": "blob", "sha": blobs[sha]})
+
+    tree = job.cli.create_tree(entries, job.base_tree)
+    if tree is None:
+        raise RuntimeError("Could not create the tree")
+
+    commit = job.cli.create_commit("Project Update via Archctl", tree, [job.base])
+    if commit is None:
+        raise RuntimeError("Could not create the commit")
+
+    if not job.cli.create_ref(RENDER_BRANCH, commit):
+        raise RuntimeError(f"Could not create the branch {RENDER_BRANCH}")
+
+
+STAGES = [clone, extract_cookies, render, merge, push, open_pr]
+
+# Stages of the upgrades that never clone the repo, the base branch is read
+# and the upgrade committed through the Git Data API
+CLONELESS_STAGES = [fetch_base, render, diff_render, commit_tree, open_pr]
+
+# Concurrency of each stage in the pipeline, None means jobs. Cookiecutter
+# changes the working dir of the process while rendering
+STAGE_LIMITS = {
+    clone: None, extract_cookies: 1, render: 1, merge: None, push: None, open_pr: None,
+    fetch_base: None, diff_render: None, commit_tree: None,
+}
+
+
+# Stages limited to a worker can't run in two threads at once either
+_serial = {stage: threading.Lock() for stage, limit in STAGE_LIMITS.items() if limit == 1}
+
+
+def run_stage(stage, job: Job):
+    """Run the stage on the job, unless a previous one failed or finished it"""
+
+    if job.result is not None:
+        return
+
+    try:
+        stage(job)
+
+    except Exception as e:
+        logger.debug(traceback.format_exc())
+        logger.error(f"Could not upgrade {job.repo.full_name}: {e}")
+        job.result = UpgradeResult(job.repo.full_name, "failed", f"{stage.__name__}: {e}")
+
+
+def finish(job: Job) -> UpgradeResult:
+    shutil.rmtree(job.workspace, ignore_errors=True)
+    logger.info(f"{job.result.repo}: {job.result.status}")
+
+    return job.result
+
+
+def new_job(repo, template, template_dir, yes, root, strategy="shallow") -> Job:
+    workspace = Path(tempfile.mkdtemp(prefix=f"{repo.repo}-", dir=root))
+    return Job(repo, template, template_dir, yes, workspace, strategy)
+
+
+def upgrade_repo(
+    repo: comm.Repo, template: comm.TemplateVersion, template_dir, yes, root, strategy="shallow",
+    stages=STAGES,
+) -> UpgradeResult:
+    """Upgrade a single repo in a workspace of its own under root: clone, render
+    the template checked out in template_dir, merge, push and open the PR"""
+
+    job = new_job(repo, template, template_dir, yes, root, strategy)
+    for stage in stages:
+        with _serial.get(stage, nullcontext()):
+            run_stage(stage, job)
+
+    return finish(job)
+
+
+def run_pipeline(jobs: list[Job], limit, stages=STAGES) -> list[UpgradeResult]:
+    """Run the jobs through the stages, each stage with its own workers (limit
+    of them unless STAGE_LIMITS says otherwise) and a queue of at most limit
+    jobs in front of it. A stage is blocked when the next one falls behind, so
+    repo N+1 clones while repo N renders and repo N-1 pushes"""
+
+    queues = [queue.Queue(maxsize=limit) for _ in stages] + [queue.Queue()]
+
+    def work(stage, inbox, outbox, workers):
+        while (job := inbox.get()) is not None:
+            run_stage(stage, job)
+            outbox.put(job)
+
+        # Let the siblings know, the last one to stop tells the next stage
+        inbox.put(None)
+        with workers["lock"]:
+            workers["alive"] -= 1
+            if workers["alive"] == 0:
+                outbox.put(None)
+
+    threads = []
+    for stage, inbox, outbox in zip(stages, queues, queues[1:]):
+        count = STAGE_LIMITS[stage] or limit
+        workers = {"alive": count, "lock": threading.Lock()}
+        for _ in range(count):
+            threads.append(threading.Thread(target=work, args=(stage, inbox, outbox, workers), daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    for job in jobs:
+        queues[0].put(job)
+    queues[0].put(None)
+
+    results = {}
+    while (job := queues[-1].get()) is not None:
+        results[id(job)] = finish(job)
+
+    for thread in threads:
+        thread.join()
+
+    return [results[id(job)] for job in jobs]
+
+
+def run(
+    repos, template: comm.TemplateVersion, yes, jobs=1, pipeline=False, strategy="shallow",
+    cloneless=False,
+) -> list[UpgradeResult]:
+    """Upgrade every repo, jobs of them at a time in a pool of threads, or in
+    a staged pipeline of threads. Either way they share the connections, the
+    caches and the rate limit of the process. Every run gets a temp root of
+    its own, with a workspace per repo. Results are returned in the same order
+    as the repos. Cloneless upgrades only talk to the API, strategy is ignored
+    then"""
+
+    stages = CLONELESS_STAGES if cloneless else STAGES
+
+    # Prompting for the cookies of many repos at once doesn't work, the
+    # pipeline renders one repo at a time anyway
+    if not yes and not pipeline:
+        jobs = 1
+
+    root = Path(tempfile.mkdtemp(prefix="archctl-upgrade-"))
+    logger.debug(f"Upgrading {len(repos)} repos in {root}, {jobs} at a time")
+
+    try:
+        # The template is checked out once and rendered from disk by every repo
+        template_dir = get_template_dir(template)
+
+        if pipeline:
+            return run_pipeline(
+                [new_job(repo, template, template_dir, yes, root, strategy) for repo in repos],
+                jobs,
+                stages,
+            )
+
+        if jobs <= 1:
+            return [
+                upgrade_repo(repo, template, template_dir, yes, root, strategy, stages)
+                for repo in repos
+            ]
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(
+                    upgrade_repo, repo, template, template_dir, yes, root, strategy, stages
+                ): i
+                for i, repo in enumerate(repos)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+
+        return [results[i] for i in range(len(repos))]
+
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def print_results(results: list[UpgradeResult]):
+    width = max((len(r.repo) for r in results), default=0)
+
+    click.echo("Upgrade results:")
+    for r in results:
+        click.echo(f"\t{r.repo:<{width}}  {r.status}" + (f"  ({r.detail})" if r.detail else ""))
@@ -44,6 +44,10 @@ class UserConfig(ABC):
     def repo_exists(self, repo):
         """Check if a repo exists"""
 
+    @abstractmethod
+    def get_setting(self, key, default=None):
+        """Get the value of an optional setting of the user config"""
+
 
 class JSONConfig(UserConfig):
 
@@ -175,3 +179,11 @@ class JSONConfig(UserConfig):
             t_repos = False
 
         return p_repos or t_repos
+
+    def get_setting(self, key, default=None):
+        """Get the value of an optional setting of the user config"""
+        config = self.__read_user_config()
+        if not config:
+            return default
+
+        return config.get(key, default)
@@ -1,22 +1,39 @@
+import json
 import logging
 import pathlib
 import re
 import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from itertools import islice
 from pprint import pprint
 
 import igittigitt
 
-from archctl.github import GHCli
+from archctl.github import PER_PAGE, GithubIface
+from archctl.search_cache import Watermarks, covers
+from archctl.template_index import get_index
 import archctl.commons as comm
 
-cookiecutter_dir_pattern = re.compile("^(.*\/)*\{\{cookiecutter\..*\}\}$")
+# Headers of each kind of change in the diffs, in the order they are printed
+DIFF_HEADERS = {"A": "Added files:", "D": "Deleted files:", "M": "Modified files:"}
+
+cookiecutter_dir_pattern = re.compile(r"^(.*\/)*\{\{cookiecutter\..*\}\}$")
 
 logger = logging.getLogger(__name__)
 
+# Subtrees fetched at once when a recursive tree comes back truncated
+TREE_JOBS = 8
+
+# Results held per job waiting for a slower inspection, when the order is stable
+REORDER_WINDOW = 4
 
-def get_ignore_parser(path):
+
+def get_ignore_parser(path, base_dir=None):
+    """Parser of the ignore file, its rules are relative to base_dir, the dir
+    of the file if None"""
     parser = igittigitt.IgnoreParser()
-    parser.parse_rule_file(path)
+    parser.parse_rule_file(path, base_dir=base_dir)
     return parser
 
 
@@ -33,9 +50,10 @@ def move_dir(src_path, dest_path, ignore_path=None):
     # Get the pathlib.Path object of all the dirs in the src_path
     dirs = [dir for dir in src_path.glob("./**/*") if dir.is_dir()]
 
-    # Exclude all the files matched by the rules in the ignore file
+    # Exclude all the files matched by the rules in the ignore file, which are
+    # relative to the root of the project, the one of the render here
     if ignore_path is not None:
-        parser = get_ignore_parser(ignore_path)
+        parser = get_ignore_parser(ignore_path, src_path)
         files = [file for file in files if not parser.match((file))]
         dirs = [dir for dir in dirs if not parser.match((dir))]
 
@@ -73,80 +91,197 @@ def print_diff(name, diff):
 
 
 def print_diffs(diffs, show_add):
-    # Print additions
-    print("Added files:")
-    for addition in diffs["A"]:
-        if show_add:
-            print_diff(addition["name"], addition["diff"])
-        else:
-            print("+ " + addition["name"])
-
-    # Print deletions
-    print("Deleted files:")
-    for addition in diffs["D"]:
-        print(f"- {addition}")
-
-    # Print modifications
-    print("Modified files:")
-    for addition in diffs["M"]:
-        print_diff(addition["name"], addition["diff"])
-
-
-def has_templates(cli: GHCli, ref=None):
+    """Print the diffs grouped by change, as they are generated. The lines of
+    the added files are never read unless show_add"""
+
+    diffs = iter(diffs)
+    diff = next(diffs, None)
+
+    for change, header in DIFF_HEADERS.items():
+        print(header)
+
+        while diff is not None and diff.change == change:
+            if change == "M" or (change == "A" and show_add):
+                print_diff(diff.path, diff.lines)
+            else:
+                print(f"{'+' if change == 'A' else '-'} {diff.path}")
+
+            diff = next(diffs, None)
+
+
+def print_stat(stats):
+    """Print the lines added and deleted in every file as git counts them,
+    with the totals at the end. Binary files are counted as -"""
+
+    files = added = deleted = 0
+    for path, file_added, file_deleted in stats:
+        files += 1
+        added += file_added or 0
+        deleted += file_deleted or 0
+
+        counts = [str(count) if count is not None else "-" for count in (file_added, file_deleted)]
+        print(f"{counts[0]:>8} {counts[1]:>8}  {path}")
+
+    print(f"{files} files changed, {added} insertions(+), {deleted} deletions(-)")
+
+
+def has_templates(cli: GithubIface, ref=None):
     """Returns true if the repo has cookiecutter templates at the given ref"""
 
-    # Get the tree of files recursively, to get all the files in the repo
-    # with the lowest amount of info
-    tree = cli.get_tree(ref, "1")
+    return bool(search_templates(cli, ref))
 
-    if not tree:
-        return False
 
-    for dir in tree["tree"]:
-        if dir["mode"] == "040000" and cookiecutter_dir_pattern.match(dir["path"]):
-            return True
+def is_cookiecutter_dir(path: str) -> bool:
+    """Same as matching cookiecutter_dir_pattern, in linear time: some
+    component starts with "{{cookiecutter." and the path ends with "}}".
+    """
 
-    return False
+    return path.endswith("}}") and (
+        path.startswith("{{cookiecutter.") or "/{{cookiecutter." in path
+    )
 
 
-def not_relative(path: pathlib.Path, others: list[pathlib.Path]):
-    for other in others:
-        if path != other and path.is_relative_to(other):
-            return False
+def top_level_paths(paths: list[str]) -> list[str]:
+    """Select the paths that aren't under any other one of them, in their
+    original order. Sorting the paths by their parts places the descendants of
+    a path right after it, so a single pass over them is enough: O(n log n)"""
 
-    return True
+    top_level = set()
+    last = None
+
+    for parts in sorted({tuple(path.split("/")) for path in paths}):
+        if last is None or parts[:len(last)] != last:
+            top_level.add(parts)
+            last = parts
+
+    return [path for path in paths if tuple(path.split("/")) in top_level]
 
 
-def search_templates(cli: GHCli, ref: str | None = None) -> list[comm.Template]:
+def search_templates(cli: GithubIface, ref: str | None = None) -> list[comm.Template]:
     """Search for cookiecutter templates in the given repo@ref
     Returns a dictionary where the name of the template is the key and
     the path to the template is the value.
     """
 
-    # Get the tree of files recursively, to get all the files in the repo
-    # with the lowest amount of info
-    tree = cli.get_tree(ref, "1")
+    # Refs sharing the same tree share the same templates
+    tree_sha = cli.get_tree_sha(ref) or (cli.get_tree(ref) or {}).get("sha")
+    if tree_sha is None:
+        return []
+
+    return tree_templates(cli, tree_sha)
+
 
-    if not tree:
+def tree_templates(cli: GithubIface, tree_sha: str) -> list[comm.Template]:
+    """Search for cookiecutter templates in the given tree, looking it up in the
+    template index before downloading the whole tree"""
+
+    index = get_index()
+    templates = index.get(tree_sha, cli.cw_repo)
+    if templates is not None:
+        return templates
+
+    # Get the directories of the tree recursively, with the lowest amount of info
+    dirs = walk_tree(cli, tree_sha)
+    if dirs is None:
+        logger.debug(f"Tree {tree_sha} couldn't be walked whole, it isn't indexed")
         return []
 
+    templates = find_templates(cli.cw_repo, dirs)
+    index.put(tree_sha, templates)
+
+    return templates
+
+
+def resolve_templates(cli: GithubIface, commits, jobs=1) -> dict:
+    """Get the templates at each of the commits. Each distinct commit is
+    resolved to its tree once and each distinct tree is scanned once, jobs of
+    them at a time, so the cost grows with the trees instead of the commits"""
+
+    commits = list(dict.fromkeys(commits))
+    trees = dict(zip(commits, run_inspections([partial(cli.get_tree_sha, c) for c in commits], jobs)))
+
+    distinct = [tree for tree in dict.fromkeys(trees.values()) if tree is not None]
+    logger.debug(f"{len(commits)} commits share {len(distinct)} distinct trees")
+    templates = dict(zip(distinct, run_inspections([partial(tree_templates, cli, t) for t in distinct], jobs)))
+
+    return {commit: templates.get(tree, []) for commit, tree in trees.items()}
+
+
+def expand_tree(cli: GithubIface, prefix, sha):
+    """Get the dirs under the tree and the subtrees of it left to expand when
+    GitHub truncates it, None if the tree couldn't be fetched"""
+
+    tree = cli.get_tree(sha, "1") or {}
+    if "tree" not in tree:
+        return None
+
+    if not tree.get("truncated"):
+        dirs = [e["path"] for e in tree["tree"] if e["mode"] == "040000"]
+        return [f"{prefix}{path}" for path in dirs], []
+
+    logger.debug(f"Tree {prefix or '/'} is truncated, expanding its subtrees")
+    tree = cli.get_tree(sha) or {}
+    if "tree" not in tree:
+        return None
+
+    dirs, pending = [], []
+    for entry in tree["tree"]:
+        if entry["mode"] != "040000":
+            continue
+        path = f"{prefix}{entry['path']}"
+        dirs.append(path)
+        if not is_cookiecutter_dir(path):
+            pending.append((f"{path}/", entry["sha"]))
+
+    return dirs, pending
+
+
+def walk_tree(cli: GithubIface, tree_sha: str, jobs: int = TREE_JOBS):
+    """Get the directories under the tree, as the entries of a recursive tree.
+    Each tree is fetched recursively, and when GitHub truncates it its subtrees
+    are expanded breadth-first, jobs at a time. Blobs are dropped, and the dirs
+    under a cookiecutter dir are never expanded as they can't hold a template.
+    None if the tree or any of its subtrees couldn't be fetched"""
+
+    entries = []
+    level = [("", tree_sha)]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while level:
+            next_level = []
+            for expanded in executor.map(lambda subtree: expand_tree(cli, *subtree), level):
+                if expanded is None:
+                    return None
+                dirs, pending = expanded
+                entries += ({"path": path, "mode": "040000"} for path in dirs)
+                next_level += pending
+            level = next_level
+
+    return entries
+
+
+def find_templates(repo: comm.Repo, entries) -> list[comm.Template]:
+    """Find the cookiecutter templates among the entries of a git tree"""
+
     # Get all the directories in the tree that match the cookiecutter project
     # template folder regular expresion --> ^(.*\/)*\{\{cookiecutter\..*\}\}$
-    cc_dirs_path = [
-        pathlib.Path(dir["path"])
-        for dir in tree["tree"]
-        if (dir["mode"] == "040000" and cookiecutter_dir_pattern.match(dir["path"]))
+    cc_dirs = [
+        dir["path"]
+        for dir in entries
+        if dir["mode"] == "040000" and is_cookiecutter_dir(dir["path"])
     ]
 
     # Select only the parent cc directories
-    paths = [path for path in cc_dirs_path if not_relative(path, cc_dirs_path)]
+    paths = [pathlib.PurePosixPath(path) for path in top_level_paths(cc_dirs)]
+
+    if not paths:
+        return []
 
     if len(paths[0].parts) == 1:  # Root directory contains a cookiecutter template
-        return [comm.Template(cli.cw_repo.repo, cli.cw_repo, None)]
+        return [comm.Template(repo.repo, repo, None)]
 
     # From that list of dirs, split the path to get all the folder's individual
     # names and select the name of the parent to get the template name
-    return [comm.Template(t.parent.name, cli.cw_repo, str(t.parent)) for t in paths]
+    return [comm.Template(t.parent.name, repo, str(t.parent)) for t in paths]
 
 
 def __key_exists(dictionary, *keys):
@@ -164,52 +299,114 @@ def __key_exists(dictionary, *keys):
 
 
 def inspect_branch_template(
-    search_resul: dict, cli: GHCli, branch, depth, template: comm.Template
+    search_resul: dict,
+    cli: GithubIface,
+    branch,
+    depth,
+    template: comm.Template,
+    head=None,
+    watermarks: Watermarks | None = None,
 ):
 
-    branch_commits = []
-    if template.template_path is not None:
-        branch_commits = cli.get_commits(template.template_path, branch)[:depth]
-    else:
-        branch_commits = cli.get_commits(sha=branch)[:depth]
+    # Only request as many commits as needed, depth -1 means all of them
+    limit = depth if depth > 0 else None
+    per_page = depth if depth > 0 else PER_PAGE
 
-    commits = [
-        {"message": c["commit"]["message"].split("\n")[0][:60], "sha": c["sha"]}
-        for c in branch_commits
-    ]
+    branch_commits = cli.get_commits(template.template_path, head or branch, per_page)
+
+    if watermarks is None or head is None:
+        return add_branch_commits(
+            search_resul, template.template, branch, islice(branch_commits, limit)
+        )
 
-    if __key_exists(search_resul, template.template, "branches", branch):
-        search_resul[template.template]["branches"][branch] += commits
-    elif __key_exists(search_resul, template.template, "branches"):
-        search_resul[template.template]["branches"][branch] = commits
-    elif __key_exists(search_resul, template.template):
-        search_resul[template.template]["branches"] = {branch: commits}
+    commits = incremental_commits(
+        branch_commits, depth, head, watermarks.get(branch, template.template)
+    )
+    watermarks.put(branch, head, depth, template.template, commits)
+
+    return __add_commits(search_resul, template.template, branch, commits)
+
+
+def incremental_commits(branch_commits, depth, head, watermark):
+    """Get the last depth commits of a template in a branch, given its commits
+    (as returned by the GH API) and the watermark of the last search. Commits
+    are only fetched until one that was already known"""
+
+    limit = depth if depth > 0 else None
+    known_head, known_depth, known = watermark or (None, 0, [])
+
+    # The known commits go back to the first one if they're fewer than their depth
+    complete = known_depth <= 0 or len(known) < known_depth
+
+    if head == known_head and (complete or covers(known_depth, depth)):
+        return known[:limit]
+
+    index = {commit["sha"]: i for i, commit in enumerate(known)}
+    commits = []
+
+    for commit in islice(branch_commits, limit):
+        i = index.get(commit["sha"])
+        if i is not None and (
+            complete or (limit is not None and len(commits) + len(known) - i >= limit)
+        ):
+            return (commits + known[i:])[:limit]
+
+        commits.append(short_commit(commit))
+
+    return commits
+
+
+def short_commit(commit):
+    """Message and SHA of a commit, as returned by the GH API"""
+
+    return {"message": commit["commit"]["message"].split("\n")[0][:60], "sha": commit["sha"]}
+
+
+def add_branch_commits(search_resul: dict, template: str, branch, branch_commits):
+    """Add the commits (as returned by the GH API) of a template in a branch to
+    the search results"""
+
+    commits = [short_commit(c) for c in branch_commits]
+
+    return __add_commits(search_resul, template, branch, commits)
+
+
+def __add_commits(search_resul: dict, template: str, branch, commits):
+    if __key_exists(search_resul, template, "branches", branch):
+        search_resul[template]["branches"][branch] += commits
+    elif __key_exists(search_resul, template, "branches"):
+        search_resul[template]["branches"][branch] = commits
+    elif __key_exists(search_resul, template):
+        search_resul[template]["branches"] = {branch: commits}
     else:
-        search_resul[template.template] = {"branches": {branch: commits}}
+        search_resul[template] = {"branches": {branch: commits}}
 
     return search_resul
 
 
 def inspect_branch(
-    search_resul: dict, cli: GHCli, branch, depth, template: comm.Template | None = None
+    search_resul: dict,
+    cli: GithubIface,
+    branch,
+    depth,
+    template: comm.Template | None = None,
+    head=None,
+    watermarks: Watermarks | None = None,
 ):
     logger.debug(f"Searching for the versions contained in {branch}")
 
-    if template is not None:
+    # Trees are looked up by commit SHA when the head is known, which is cached
+    branch_templates = [template] if template is not None else search_templates(cli, head or branch)
+
+    for branch_temp in branch_templates:
         search_resul = inspect_branch_template(
-            search_resul, cli, branch, depth, template
+            search_resul, cli, branch, depth, branch_temp, head, watermarks
         )
-    else:
-        branch_templates = search_templates(cli, branch)
-        for branch_temp in branch_templates:
-            search_resul = inspect_branch_template(
-                search_resul, cli, branch, depth, branch_temp
-            )
 
     return search_resul
 
 
-def inspect_tag_template(search_resul: dict, cli: GHCli, tag, template: str):
+def inspect_tag_template(search_resul: dict, cli: GithubIface, tag, template: str):
 
     if __key_exists(search_resul, template, "tags"):
         if tag["name"] not in search_resul[template]["tags"]:
@@ -223,7 +420,7 @@ def inspect_tag_template(search_resul: dict, cli: GHCli, tag, template: str):
 
 
 def inspect_tag(
-    search_resul: dict, cli: GHCli, tag, template: comm.Template | None = None
+    search_resul: dict, cli: GithubIface, tag, template: comm.Template | None = None
 ):
     logger.debug(f"Searching for the templates contained in {tag}")
 
@@ -241,6 +438,89 @@ def inspect_tag(
     return search_resul
 
 
+def merge_search(search_resul: dict, other: dict):
+    """Merge the partial results of an inspection into the search results,
+    leaving them as if both inspections had been run one after the other"""
+
+    for template, t_info in other.items():
+        for kind, refs in t_info.items():
+            if kind == "tags":
+                for tag in refs:
+                    search_resul = inspect_tag_template(
+                        search_resul, None, {"name": tag}, template
+                    )
+            else:
+                for branch, commits in refs.items():
+                    search_resul = __add_commits(search_resul, template, branch, commits)
+
+    return search_resul
+
+
+def iter_inspections(inspections, jobs=1, stable=True):
+    """Yield the results of the inspections as soon as they complete, with at
+    most jobs of them waiting on GitHub at any time. If stable, they are yielded
+    in the given order, holding the ones that complete early in a reorder
+    buffer of at most REORDER_WINDOW times jobs results"""
+
+    if jobs <= 1:
+        yield from (inspection() for inspection in inspections)
+        return
+
+    window = jobs * REORDER_WINDOW
+    inspections = enumerate(inspections)
+    pending, completed, next_index = {}, {}, 0
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        def submit():
+            for index, inspection in islice(inspections, window - len(pending) - len(completed)):
+                pending[executor.submit(inspection)] = index
+
+        submit()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                index = pending.pop(future)
+                if stable:
+                    completed[index] = future.result()
+                else:
+                    yield future.result()
+
+            while next_index in completed:
+                yield completed.pop(next_index)
+                next_index += 1
+
+            submit()
+
+
+def run_inspections(inspections, jobs=1):
+    """Run the inspections concurrently, with at most jobs of them waiting
+    on GitHub at any time. Returns their results in the given order"""
+
+    return list(iter_inspections(inspections, jobs))
+
+
+def search_records(search_resul: dict):
+    """Flatten the search results into one record per tag and commit"""
+
+    for template, t_info in search_resul.items():
+        for tag in t_info.get("tags", []):
+            yield {"template": template, "type": "tag", "ref": tag}
+
+        for branch, commits in t_info.get("branches", {}).items():
+            for commit in commits:
+                yield {"template": template, "type": "commit", "ref": branch, **commit}
+
+
+def print_records(records):
+    """Print the records as JSON lines, flushed one by one so they can be
+    consumed while the search goes on"""
+
+    for record in records:
+        print(json.dumps(record), flush=True)
+
+
 def print_search(search_resul: dict, tags: bool):
     if search_resul:
         print("The following Templates were found in the specified repo:")
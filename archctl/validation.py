@@ -2,7 +2,7 @@
 import click
 import logging
 
-from archctl.github import GHCli
+from archctl.github import get_gh_client
 from archctl.user_config import JSONConfig
 import archctl.utils as util
 import archctl.commons as comm
@@ -15,7 +15,7 @@ DENY = ["no", "n"]
 
 class Validation:
     def __init__(self, interactive: bool = False):
-        self.cli = GHCli()
+        self.cli = get_gh_client()
         self.uc = JSONConfig()
         self.interactive = interactive
 
@@ -74,7 +74,7 @@ class Validation:
     def branch_exists_in_repo(self, repo: comm.Repo, branch):
         """Returns a list of the"""
         self.cli.cw_repo = repo
-        if branch not in [b["name"] for b in self.cli.list_branches()]:
+        if not self.cli.branch_exists(branch):
             if self.interactive:
                 return False
             else:
@@ -0,0 +1,91 @@
+"""Compare the template lookup of archctl.utils.find_templates against the
+previous regex + pairwise is_relative_to filter, on a synthetic monorepo tree
+
+    python benchmarks/bench_search_templates.py --entries 100000 --templates 1000
+"""
+import argparse
+import pathlib
+import random
+import re
+import time
+
+import archctl.commons as comm
+import archctl.utils as utils
+
+cookiecutter_dir_pattern = re.compile(r"^(.*\/)*\{\{cookiecutter\..*\}\}$")
+
+
+def naive_find_templates(repo, entries):
+    cc_dirs_path = [
+        pathlib.Path(dir["path"])
+        for dir in entries
+        if (dir["mode"] == "040000" and cookiecutter_dir_pattern.match(dir["path"]))
+    ]
+
+    paths = [
+        path for path in cc_dirs_path
+        if all(path == other or not path.is_relative_to(other) for other in cc_dirs_path)
+    ]
+
+    if not paths:
+        return []
+    if len(paths[0].parts) == 1:
+        return [comm.Template(repo.repo, repo, None)]
+
+    return [comm.Template(t.parent.name, repo, str(t.parent)) for t in paths]
+
+
+def synthetic_tree(entries, templates, seed=0):
+    """Tree of a monorepo with the given number of templates, each one with
+    nested cookiecutter dirs, padded with regular dirs and files"""
+
+    rng = random.Random(seed)
+    tree = []
+
+    for i in range(templates):
+        base = f"templates/group{i % 50}/template{i}"
+        cc = f"{base}/{{{{cookiecutter.project_slug}}}}"
+        tree += [
+            {"path": base, "mode": "040000"},
+            {"path": cc, "mode": "040000"},
+            {"path": f"{cc}/{{{{cookiecutter.module}}}}", "mode": "040000"},
+            {"path": f"{cc}/README.md", "mode": "100644"},
+        ]
+
+    while len(tree) < entries:
+        depth = rng.randint(1, 6)
+        path = "/".join(f"dir{rng.randint(0, 200)}" for _ in range(depth))
+        mode = rng.choice(["040000", "100644", "100644"])
+        tree.append({"path": path, "mode": mode})
+
+    tree.sort(key=lambda e: e["path"])
+    return tree
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--templates", type=int, default=1000)
+    args = parser.parse_args()
+
+    repo = comm.Repo("archctl", "bench", "archctl/bench", None, None, None)
+    tree = synthetic_tree(args.entries, args.templates)
+
+    fast, fast_time = timed(utils.find_templates, repo, tree)
+    naive, naive_time = timed(naive_find_templates, repo, tree)
+
+    assert fast == naive, "Both implementations must find the same templates"
+
+    print(f"{len(tree)} entries, {len(fast)} templates")
+    print(f"naive:         {naive_time:8.3f}s")
+    print(f"find_templates:{fast_time:8.3f}s  ({naive_time / fast_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,8 @@ requirements = [
     'InquirerPy',
     'cookiecutter',
     'GitPython',
-    'igittigitt'
+    'igittigitt',
+    'requests'
 ]
 
 setup(
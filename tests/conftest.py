@@ -0,0 +1,96 @@
+"""Fixtures and git helpers shared by every test module"""
+import json
+import subprocess
+
+import pytest
+
+import archctl.commons as comm
+import archctl.github as gh
+import archctl.http_cache as hc
+import archctl.render_cache as rcache
+import archctl.repo_cache as rc
+import archctl.search_cache as sc
+import archctl.template_cache as tc
+import archctl.template_index as ti
+import archctl.upgrade as upgrader
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(monkeypatch, tmp_path):
+    """Keep the persistent and process wide caches of archctl per test"""
+
+    monkeypatch.setattr(comm, "CACHE_DIR", tmp_path / "cache")
+    hc.get_cache.cache_clear()
+    ti.get_index.cache_clear()
+    sc.get_watermarks.cache_clear()
+    rc.get_repo_cache.cache_clear()
+    rcache._used.clear()
+    tc._used.clear()
+    gh._memo.clear()
+
+    yield comm.CACHE_DIR
+
+    hc.get_cache.cache_clear()
+    ti.get_index.cache_clear()
+    sc.get_watermarks.cache_clear()
+    rc.get_repo_cache.cache_clear()
+    rcache._used.clear()
+    tc._used.clear()
+    gh._memo.clear()
+
+
+class FakeCli:
+    cw_repo = None
+
+    def get_default_branch(self):
+        return "main"
+
+    def create_pr(self, head, base, title=""):
+        return True
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    """Home and git identity of the upgrades, which open their PRs nowhere"""
+
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    for var in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{var}_NAME", "archctl")
+        monkeypatch.setenv(f"GIT_{var}_EMAIL", "archctl@example.com")
+    monkeypatch.setattr(upgrader, "get_gh_client", FakeCli)
+    return tmp_path
+
+
+def git(path, *args):
+    return subprocess.run(
+        ["git", "-C", str(path), *args], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def commit_files(path, files, message):
+    for name, content in files.items():
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_text(content)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", message)
+
+
+def local_repo(tmp_path, name, files):
+    """Bare repo standing for the GitHub one, with a commit of the files"""
+
+    work = tmp_path / "work" / name
+    git(tmp_path, "init", "-q", "-b", "main", str(work))
+    commit_files(work, files, "Initial commit")
+    git(tmp_path, "clone", "-q", "--bare", str(work), str(tmp_path / f"{name}.git"))
+
+    return comm.Repo("archctl", name, f"archctl/{name}", str(tmp_path / f"{name}.git"), None, None)
+
+
+def template(tmp_path, files=None):
+    t_repo = local_repo(tmp_path, "templates", {
+        "python/cookiecutter.json": json.dumps({"name": "service", "owner": "nobody"}),
+        "python/{{cookiecutter.name}}/README.md": "# {{cookiecutter.name}} by {{cookiecutter.owner}}\n",
+        "python/{{cookiecutter.name}}/src/app.py": "print('{{cookiecutter.name}}')\n",
+        **{f"python/{{{{cookiecutter.name}}}}/{name}": content for name, content in (files or {}).items()},
+    })
+    return comm.TemplateVersion(comm.Template("python", t_repo, "python"), "main")
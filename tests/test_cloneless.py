@@ -0,0 +1,199 @@
+"""Cloneless upgrades, against a fake GitHub API serving local bare repos"""
+import base64
+import json
+import os
+import re
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pytest
+
+import archctl.github as gh
+import archctl.upgrade as upgrader
+from tests.conftest import git, local_repo, template
+
+route_pattern = re.compile(r"/repos/archctl/([^/]+)(/.*)?")
+
+
+def plumbing(path, *args, input=None, extra_env=None):
+    return subprocess.run(
+        ["git", "-C", str(path), *args], check=True, capture_output=True, input=input,
+        env={**os.environ, **(extra_env or {})},
+    ).stdout.strip().decode()
+
+
+class GitDataGithub(BaseHTTPRequestHandler):
+    """Serves the endpoints of the Git Data API the cloneless upgrades use out
+    of the bare repos in origins, recording every request made to it"""
+
+    origins = {}
+    requests = []
+    truncated = False
+
+    def route(self):
+        url = urlsplit(self.path)
+        name, endpoint = route_pattern.fullmatch(url.path).groups()
+        return self.origins[name], endpoint or "", parse_qs(url.query)
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def do_GET(self):
+        self.requests.append(("GET", self.path, None))
+        origin, endpoint, query = self.route()
+
+        try:
+            if endpoint == "":
+                self.reply(200, {"default_branch": "main"})
+
+            elif endpoint.startswith("/branches/"):
+                sha = plumbing(origin, "rev-parse", f"refs/heads/{endpoint[10:]}")
+                tree = plumbing(origin, "rev-parse", f"{sha}^{{tree}}")
+                self.reply(200, {"commit": {"sha": sha, "commit": {"tree": {"sha": tree}}}})
+
+            elif endpoint.startswith("/git/trees/"):
+                sha = endpoint[11:]
+                recursive = "recursive" in query
+                output = plumbing(origin, "ls-tree", "-z", *(["-r", "-t"] if recursive else []), sha)
+
+                tree = []
+                for line in filter(None, output.split("\0")):
+                    info, path = line.split("\t", 1)
+                    mode, type, object_sha = info.split(" ")
+                    tree.append({"path": path, "mode": mode, "type": type, "sha": object_sha})
+
+                # GitHub cuts big recursive trees short
+                if recursive and self.truncated:
+                    tree = tree[:1]
+                self.reply(200, {"sha": sha, "tree": tree, "truncated": recursive and self.truncated})
+
+            elif endpoint.startswith("/contents/"):
+                ref = query.get("ref", ["main"])[0]
+                content = subprocess.run(
+                    ["git", "-C", str(origin), "show", f"{ref}:{unquote(endpoint[10:])}"],
+                    check=True, capture_output=True,
+                ).stdout
+                encoded = base64.b64encode(content).decode()
+                self.reply(200, {"type": "file", "encoding": "base64", "content": encoded})
+
+            else:
+                self.reply(404, {"message": "Not Found"})
+
+        except subprocess.CalledProcessError:
+            self.reply(404, {"message": "Not Found"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append(("POST", self.path, body))
+        origin, endpoint, _ = self.route()
+
+        if endpoint == "/git/blobs":
+            content = base64.b64decode(body["content"])
+            sha = plumbing(origin, "hash-object", "-w", "--stdin", input=content)
+
+        elif endpoint == "/git/trees":
+            index = {"GIT_INDEX_FILE": str(origin / "archctl-index")}
+            plumbing(origin, "read-tree", body.get("base_tree", "--empty"), extra_env=index)
+            for entry in body["tree"]:
+                cacheinfo = f"{entry['mode']},{entry['sha']},{entry['path']}"
+                plumbing(origin, "update-index", "--add", "--cacheinfo", cacheinfo, extra_env=index)
+            sha = plumbing(origin, "write-tree", extra_env=index)
+
+        elif endpoint == "/git/commits":
+            parents = [arg for parent in body["parents"] for arg in ("-p", parent)]
+            sha = plumbing(origin, "commit-tree", body["tree"], *parents, "-m", body["message"])
+
+        elif endpoint == "/git/refs":
+            plumbing(origin, "update-ref", body["ref"], body["sha"])
+            sha = body["sha"]
+
+        else:
+            self.reply(201, {"html_url": "https://github.com/pr/1"})
+            return
+
+        self.reply(201, {"sha": sha})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api(env, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GitDataGithub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    monkeypatch.setattr(gh, "API_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(upgrader, "get_gh_client", gh.GHApi)
+    monkeypatch.setattr(GitDataGithub, "truncated", False)
+    gh._api_session.cache_clear()
+    GitDataGithub.origins.clear()
+    GitDataGithub.requests.clear()
+
+    yield GitDataGithub
+
+    server.shutdown()
+    gh._api_session.cache_clear()
+
+
+def served_repo(tmp_path, name, files):
+    """Repo only reachable through the fake API, cloning it fails"""
+
+    repo = local_repo(tmp_path, name, files)
+    GitDataGithub.origins[name] = tmp_path / f"{name}.git"
+    repo.ssh_url = str(tmp_path / "nowhere.git")
+
+    return repo
+
+
+@pytest.mark.parametrize("truncated", [False, True])
+def test_cloneless_upgrade(env, api, truncated):
+    api.truncated = truncated
+    t = template(env)
+    repo = served_repo(env, "svc", {
+        "README.md": "old\n",
+        "src/app.py": "print('service')\n",
+        "docs/index.md": "docs\n",
+    })
+
+    result = upgrader.run([repo], t, yes=True, cloneless=True)[0]
+
+    assert result.status == "upgraded"
+    origin = env / "svc.git"
+    assert git(origin, "show", f"{upgrader.RENDER_BRANCH}:README.md") == "# service by nobody"
+    assert git(origin, "show", f"{upgrader.RENDER_BRANCH}:docs/index.md") == "docs"
+    assert git(origin, "rev-parse", f"{upgrader.RENDER_BRANCH}~1") == git(origin, "rev-parse", "main")
+
+    # Only the changed file is uploaded, in a handful of requests
+    posts = [(path.split("/", 4)[-1], body) for method, path, body in api.requests if method == "POST"]
+    assert [path for path, _ in posts] == ["git/blobs", "git/trees", "git/commits", "git/refs", "pulls"]
+    assert [entry["path"] for entry in posts[1][1]["tree"]] == ["README.md"]
+    assert posts[4][1]["head"] == upgrader.RENDER_BRANCH and posts[4][1]["base"] == "main"
+
+
+def test_cloneless_cookies_and_ignore(env, api):
+    t = template(env)
+    repo = served_repo(env, "svc", {
+        "cookiecutter.yaml": "default_context:\n  owner: team-b\n",
+        ".archignore": "src/\n",
+        "README.md": "old\n",
+    })
+
+    assert upgrader.run([repo], t, yes=True, cloneless=True)[0].status == "upgraded"
+
+    origin = env / "svc.git"
+    assert git(origin, "show", f"{upgrader.RENDER_BRANCH}:README.md") == "# service by team-b"
+    assert git(origin, "ls-tree", "--name-only", upgrader.RENDER_BRANCH, "src/") == ""
+
+    # Merge the upgrade, nothing is left to upgrade then
+    git(origin, "update-ref", "refs/heads/main", f"refs/heads/{upgrader.RENDER_BRANCH}")
+    git(origin, "branch", "-D", upgrader.RENDER_BRANCH)
+    api.requests.clear()
+
+    assert upgrader.run([repo], t, yes=True, cloneless=True)[0].status == "up to date"
+    assert not [r for r in api.requests if r[0] == "POST"]
@@ -0,0 +1,75 @@
+"""Auth session of archctl.commons"""
+import json
+import subprocess
+
+import pytest
+
+import archctl.commons as comm
+
+
+class FakeGh:
+    """Stands for the gh CLI, counting how many times it is run"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, cmd, **kwargs):
+        self.calls.append(" ".join(cmd))
+        if cmd[:3] == ["gh", "auth", "status"]:
+            out = b"github.com\n  \xe2\x9c\x93 Logged in to github.com account octocat (keyring)\n"
+        else:
+            out = b"gho_secret\n"
+        return subprocess.CompletedProcess(cmd, 0, out, b"")
+
+
+@pytest.fixture
+def gh(monkeypatch):
+    fake = FakeGh()
+    monkeypatch.setattr(comm.subprocess, "run", fake)
+    return fake
+
+
+def test_verified_once(gh, tmp_path):
+    session = comm.AuthSession(tmp_path / "auth.json", 0)
+
+    assert session.verify()
+    assert session.login == "octocat"
+    assert session.token == session.token == "gho_secret"
+    assert gh.calls == ["gh auth status", "gh auth token"]
+
+
+def test_verification_stamp(gh, tmp_path):
+    comm.AuthSession(tmp_path / "auth.json", 60).verify()
+
+    # A later process trusts the stamp instead of running gh again
+    assert comm.AuthSession(tmp_path / "auth.json", 60).login == "octocat"
+    assert gh.calls == ["gh auth status"]
+
+    # The token is never persisted
+    assert "gho_secret" not in (tmp_path / "auth.json").read_text()
+
+
+def test_verification_stamp_expired(gh, tmp_path):
+    (tmp_path / "auth.json").write_text(json.dumps({"login": "octocat", "verified": 0}))
+
+    comm.AuthSession(tmp_path / "auth.json", 60).verify()
+    comm.AuthSession(tmp_path / "auth.json", 60).verify()
+
+    # Only the first one had to verify again, the second trusts its stamp
+    assert gh.calls == ["gh auth status"]
+
+
+@pytest.mark.parametrize("env_ttl, ttl", [(None, 0), ("60", 60)])
+def test_verification_stamp_opt_in(gh, monkeypatch, env_ttl, ttl):
+    if env_ttl is None:
+        monkeypatch.delenv("ARCHCTL_AUTH_TTL", raising=False)
+    else:
+        monkeypatch.setenv("ARCHCTL_AUTH_TTL", env_ttl)
+    comm.get_auth_session.cache_clear()
+
+    session = comm.get_auth_session()
+    session.verify()
+    comm.get_auth_session.cache_clear()
+
+    assert session.ttl == ttl
+    assert (comm.CACHE_DIR / "auth.json").exists() == bool(ttl)
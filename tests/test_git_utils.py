@@ -0,0 +1,125 @@
+"""Diffs of archctl.git_utils, between local git repos"""
+from git.repo import Repo
+
+import archctl.git_utils as gu
+import archctl.utils as utils
+from tests.conftest import commit_files, git, local_repo
+
+
+def rendered(env, files, changes):
+    """Clone of a repo with the files, with the changes committed on top"""
+
+    repo = local_repo(env, "svc", files)
+    clone = Repo.clone_from(repo.ssh_url, env / "clone")
+
+    for name, content in changes.items():
+        path = env / "clone" / name
+        if content is None:
+            path.unlink()
+        elif isinstance(content, bytes):
+            path.write_bytes(content)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(content)
+    commit_files(env / "clone", {}, "Render")
+
+    return clone
+
+
+def test_diff_branches(env):
+    clone = rendered(env, {"README.md": "old\nsame\n", "LICENSE": "MIT\n", "logo.png": "a"}, {
+        "README.md": "new\nsame\n",
+        "LICENSE": None,
+        "src/app.py": "print('service')\n",
+        "data.bin": b"\x89PNG\0\0" + bytes(range(256)),
+        "logo.png": b"\0",
+    })
+
+    diffs = {diff.path: (diff.change, list(diff.lines)) for diff in gu.diff_branches(clone, "main")}
+
+    assert diffs == {
+        "data.bin": ("A", ["Binary file"]),
+        "src/app.py": ("A", ["+print('service')"]),
+        "LICENSE": ("D", []),
+        "README.md": ("M", ["--- a/README.md", "+++ b/README.md", "@@ -1,2 +1,2 @@", "-old", "+new", " same"]),
+        "logo.png": ("M", ["Binary files differ"]),
+    }
+
+
+def test_diff_branches_truncated(env):
+    clone = rendered(env, {"README.md": "old\n"}, {
+        "a.txt": "a\n" * 10,
+        "b.txt": "b\n" * 2,
+        "c.txt": "c\n",
+        "d.txt": "d\n" * 4,
+        "e.txt": "e\n",
+    })
+
+    diffs = gu.diff_branches(clone, "main", max_file=8, max_total=18)
+
+    assert [(diff.path, list(diff.lines)) for diff in diffs] == [
+        ("a.txt", ["+a", "+a", gu.TRUNCATED]),
+        ("b.txt", ["+b", "+b"]),
+        ("c.txt", ["+c"]),
+        ("d.txt", ["+d", gu.TRUNCATED]),
+        ("e.txt", [gu.TRUNCATED]),
+    ]
+
+
+def test_print_diffs_lazily(env, capsys):
+    clone = rendered(env, {"README.md": "old\n", "LICENSE": "MIT\n"}, {
+        "README.md": "new\n",
+        "LICENSE": None,
+        "src/app.py": "print('service')\n",
+    })
+
+    diffs = list(gu.diff_branches(clone, "main"))
+    utils.print_diffs(diffs, show_add=False)
+
+    out = capsys.readouterr().out
+    assert "Added files:\n+ src/app.py\nDeleted files:\n- LICENSE\nModified files:\n" in out
+    assert "+new" in out
+
+    # The added files are left unread
+    assert list(diffs[0].lines) == ["+print('service')"]
+    assert git(env / "clone", "status", "--porcelain") == ""
+
+
+def test_git_diff_branches(env):
+    clone = rendered(env, {"README.md": "old\nsame\n", "LICENSE": "MIT\n", "logo.png": "a"}, {
+        "README.md": "new\nsame\n",
+        "LICENSE": None,
+        "src/app.py": "print('service')\n",
+        "the docs.md": "docs\n" * 100,
+        "logo.png": b"\0",
+    })
+
+    diffs = [(diff.change, diff.path, list(diff.lines)) for diff in gu.git_diff_branches(clone, "main", max_file=200)]
+
+    assert [diff[:2] for diff in diffs] == [
+        ("A", "src/app.py"), ("A", "the docs.md"), ("D", "LICENSE"), ("M", "README.md"), ("M", "logo.png"),
+    ]
+    assert diffs[0][2][0] == "diff --git a/src/app.py b/src/app.py"
+    assert diffs[0][2][-1] == "+print('service')"
+    assert diffs[1][2][-1] == gu.TRUNCATED
+    assert diffs[2][2] == []
+    assert diffs[3][2][-3:] == ["-old", "+new", " same"]
+    assert diffs[4][2][-1] == "Binary files a/logo.png and b/logo.png differ"
+
+    # The patches of the added files aren't even generated
+    diffs = gu.git_diff_branches(clone, "main", added=False)
+    assert [(diff.path, list(diff.lines)) for diff in diffs][:2] == [("src/app.py", []), ("the docs.md", [])]
+
+
+def test_diff_stat(env, capsys):
+    clone = rendered(env, {"README.md": "old\nsame\n", "LICENSE": "MIT\n"}, {
+        "README.md": "new\nsame\nmore\n",
+        "LICENSE": None,
+        "data.bin": b"\0\1",
+    })
+
+    stats = list(gu.diff_stat(clone, "main"))
+    assert stats == [("LICENSE", 0, 1), ("README.md", 2, 1), ("data.bin", None, None)]
+
+    utils.print_stat(stats)
+    assert capsys.readouterr().out.split("\n")[-2] == "3 files changed, 2 insertions(+), 2 deletions(-)"
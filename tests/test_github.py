@@ -0,0 +1,237 @@
+"""GitHub controllers against a local fake GitHub API"""
+import json
+import os
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+import archctl.github as gh
+import archctl.http_cache as hc
+
+SHA = "a" * 40
+
+ROUTES = {
+    "/repos/archctl/test": {"full_name": "archctl/test", "default_branch": "main"},
+    "/repos/archctl/test/branches": [{"name": "main"}, {"name": "develop"}],
+    f"/repos/archctl/test/git/trees/{SHA}": {"sha": SHA, "tree": []},
+    "/repos/archctl/big/branches": [{"name": f"b-{i}"} for i in range(250)],
+}
+
+
+class FakeGithub(BaseHTTPRequestHandler):
+    """Serves ROUTES and records every request made to it"""
+
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(("GET", self.path, dict(self.headers)))
+        url = urlsplit(self.path)
+        body = ROUTES.get(url.path)
+        link = None
+
+        # Paginate lists the same way GitHub does
+        if isinstance(body, list):
+            query = parse_qs(url.query)
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            if page * per_page < len(body):
+                host = f"http://{self.headers['Host']}"
+                link = f'<{host}{url.path}?per_page={per_page}&page={page + 1}>; rel="next"'
+            body = body[(page - 1) * per_page:page * per_page]
+
+        etag = f'"{hash(json.dumps(body))}"'
+
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200 if body is not None else 404)
+        self.send_header("Content-Type", "application/json")
+        if body is not None:
+            self.send_header("ETag", etag)
+        if link is not None:
+            self.send_header("Link", link)
+        self.end_headers()
+        self.wfile.write(json.dumps(body or {"message": "Not Found"}).encode())
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        body = json.loads(self.rfile.read(length))
+        self.requests.append(("POST", self.path, body))
+        self.send_response(201)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({"html_url": "https://github.com/pr/1"}).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGithub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    monkeypatch.setattr(gh, "API_URL", f"http://127.0.0.1:{server.server_port}")
+    gh._api_session.cache_clear()
+    FakeGithub.requests.clear()
+
+    cli = gh.GHApi()
+    cli.cw_repo = "archctl/test"
+
+    yield cli
+
+    server.shutdown()
+    gh._api_session.cache_clear()
+
+
+def test_api_reads(api):
+    assert api.get_default_branch() == "main"
+    assert api.branch_exists("develop")
+    assert not api.branch_exists("feature")
+
+    # Every request is authenticated with the token fetched once
+    assert all(r[2]["Authorization"] == "Bearer secret" for r in FakeGithub.requests)
+
+
+def test_memoized_across_controllers(api):
+    other = gh.GHApi()
+    other.cw_repo = "archctl/test"
+
+    api.get_repo_info()
+    other.get_tree()
+    other.get_repo_info()
+
+    # The default branch needed by get_tree was already known
+    assert [r[1].split("?")[0] for r in FakeGithub.requests] == [
+        "/repos/archctl/test",
+        "/repos/archctl/test/git/trees/main",
+    ]
+
+    # Writes may change any fact about the repo
+    api.create_pr("archctl/upgrade-X", "main")
+    other.get_repo_info()
+    assert FakeGithub.requests[-1][1] == "/repos/archctl/test"
+
+
+def test_memo_bounded(api, monkeypatch):
+    monkeypatch.setattr(gh, "MEMO_SIZE", 2)
+
+    api.get_repo_info()
+    next(api.list_branches())
+    api.get_tree(SHA)
+    api.cw_repo = "archctl/big"
+    next(api.list_branches())
+
+    # Trees are left to the HTTP cache and the oldest page is dropped
+    assert list(gh._memo) == [
+        f"repos/archctl/test/branches?per_page={gh.PER_PAGE}",
+        f"repos/archctl/big/branches?per_page={gh.PER_PAGE}",
+    ]
+
+
+def test_cache_revalidates(api):
+    api.get_repo_info()
+    gh._memo.clear()
+    info = api.get_repo_info()
+
+    cache = hc.get_cache()
+    assert info["default_branch"] == "main"
+    assert (cache.misses, cache.hits, cache.revalidated) == (1, 1, 1)
+    assert "If-None-Match" in FakeGithub.requests[-1][2]
+
+
+def test_cache_immutable(api):
+    api.get_tree(SHA)
+    api.get_tree(SHA)
+
+    # The tree is addressed by its SHA, so the second read never reaches the API
+    assert len(FakeGithub.requests) == 1
+
+
+def test_cache_eviction(tmp_path):
+    old, new = os.urandom(1000).hex(), os.urandom(1000).hex()
+
+    cache = hc.HTTPCache(tmp_path / "lru.sqlite", max_size=1500)
+    cache.put("old", old)
+    cache.put("new", new)
+
+    assert cache.get("old") is None
+    assert cache.get("new").body == new
+
+
+def test_cache_accessed_in_memory(tmp_path):
+    cache = hc.HTTPCache(tmp_path / "lru.sqlite", max_size=3000)
+    cache.put("old", os.urandom(1000).hex())
+    cache.put("new", os.urandom(1000).hex())
+
+    # Reading old makes new the least recently used one, once written
+    assert cache.get("old") is not None
+    assert cache._db.in_transaction is False
+    cache.put("newer", os.urandom(1000).hex())
+
+    assert cache.get("new") is None
+    assert cache.get("old") is not None
+
+
+def test_pagination(api):
+    api.cw_repo = "archctl/big"
+
+    assert len(list(api.list_branches())) == 250
+    assert len(FakeGithub.requests) == 3
+
+
+def test_pagination_stops_early(api):
+    api.cw_repo = "archctl/big"
+
+    assert api.branch_exists("b-5")
+    assert len(FakeGithub.requests) == 1
+
+    # Pages are served again from the cache, link included
+    gh._memo.clear()
+    assert [b["name"] for b in islice(api.list_branches(), 101, 103)] == ["b-101", "b-102"]
+    assert len(FakeGithub.requests) == 3
+
+
+def test_api_missing_repo(api):
+    api.cw_repo = "archctl/missing"
+
+    assert api.get_repo_info() == {}
+
+
+def test_api_create_pr(api):
+    assert api.create_pr("archctl/upgrade-X", "main", "Upgrade")
+
+    method, path, body = FakeGithub.requests[-1]
+    assert (method, path) == ("POST", "/repos/archctl/test/pulls")
+    assert body["head"] == "archctl/upgrade-X" and body["base"] == "main"
+
+
+@pytest.mark.parametrize("returncode", [0, 1])
+def test_cli_create_pr(monkeypatch, returncode):
+    monkeypatch.setattr(gh.comm, "auth_status", lambda: None)
+    runs = []
+    monkeypatch.setattr(
+        gh.subprocess, "run",
+        lambda cmd, **kw: runs.append(cmd) or subprocess.CompletedProcess(cmd, returncode, "https://pr/1\n", "exists"),
+    )
+    cli = gh.GHCli()
+    cli.cw_repo = "archctl/test"
+
+    # gh fails when the PR already exists, among others
+    assert cli.create_pr("archctl/upgrade-X", "main", "Upgrade") is (returncode == 0)
+    assert runs[0][:3] == ["gh", "pr", "create"] and "archctl/upgrade-X" in runs[0]
+
+
+def test_backend_selection(monkeypatch):
+    monkeypatch.setenv("GH_TOKEN", "secret")
+    monkeypatch.setenv("ARCHCTL_GH_BACKEND", "api")
+    gh._api_session.cache_clear()
+
+    assert isinstance(gh.get_gh_client(), gh.GHApi)
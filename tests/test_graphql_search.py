@@ -0,0 +1,172 @@
+"""GraphQL search engine against canned GraphQL responses"""
+import re
+
+import archctl.commons as comm
+import archctl.graphql_search as gs
+import archctl.template_index as ti
+
+
+def tree(*dirs):
+    """Nested GraphQL tree entries with the given template dirs"""
+    return {
+        "entries": [
+            {
+                "name": name,
+                "type": "tree",
+                "object": {"entries": [{"name": "{{cookiecutter.name}}", "type": "tree"}]},
+            }
+            for name in dirs
+        ]
+    }
+
+
+def commit(sha, tree_sha):
+    return {"oid": sha, "tree": {"oid": tree_sha}}
+
+
+REFS = {
+    "refs/heads/": [
+        {"name": "develop", "target": commit("c2", "t2")},
+        {"name": "main", "target": commit("c1", "t1")},
+    ],
+    "refs/tags/": [{"name": "v1", "target": {"target": commit("c1", "t1")}}],
+}
+
+OBJECTS = {
+    "t1": tree("java", "python"),
+    "t2": tree("java"),
+    "c1": {"history": {"nodes": [{"oid": "c1", "message": "Release\n\nbody"}]}},
+    "c2": {"history": {"nodes": [{"oid": "c2", "message": "Feature"}]}},
+}
+
+
+class FakeCli:
+    def __init__(self):
+        self.cw_repo = comm.Repo("archctl", "test", "archctl/test", None, None, None)
+        self.queries = 0
+
+    def graphql(self, query, variables=None):
+        self.queries += 1
+
+        if "refs(" in query:
+            return {
+                "repository": {
+                    "defaultBranchRef": {"name": "main", "target": commit("c1", "t1")},
+                    "refs": {"nodes": REFS[variables["prefix"]], "pageInfo": {}},
+                }
+            }
+
+        aliases = re.findall(r'(\w+): object\(oid: "(\w+)"\)', query)
+        return {"repository": {alias: OBJECTS[oid] for alias, oid in aliases if oid in OBJECTS}}
+
+
+def test_graphql_search():
+    cli = FakeCli()
+
+    resul = gs.search(cli, 3, False)
+
+    assert resul == {
+        "java": {
+            "branches": {
+                "develop": [{"message": "Feature", "sha": "c2"}],
+                "main": [{"message": "Release", "sha": "c1"}],
+            },
+        },
+        "python": {
+            "branches": {"main": [{"message": "Release", "sha": "c1"}]},
+        },
+    }
+
+    # Branch listing, the trees of main and the other branches and the histories
+    assert cli.queries == 4
+
+
+def test_graphql_search_tags():
+    cli = FakeCli()
+
+    # Only the tags are shown, the branches aren't inspected
+    assert gs.search(cli, 3, True) == {"java": {"tags": ["v1"]}, "python": {"tags": ["v1"]}}
+
+    # Branch and tag listings and the tree they share
+    assert cli.queries == 3
+
+
+def test_graphql_search_template():
+    cli = FakeCli()
+    java = comm.TemplateVersion(comm.Template("java", cli.cw_repo, "java"), None)
+
+    resul = gs.search(cli, 3, False, java)
+
+    assert list(resul) == ["java"]
+    assert list(resul["java"]["branches"]) == ["develop", "main"]
+
+
+def nested(path, leaf):
+    """Nested GraphQL tree entries of the dirs in path, three levels deep as
+    the engine requests them, the last one pointing to the leaf oid"""
+
+    name, _, rest = path.partition("/")
+    if not rest:
+        return {"entries": [{"name": name, "type": "tree", "oid": leaf}]}
+
+    return {"entries": [{"name": name, "type": "tree", "object": nested(rest, leaf)}]}
+
+
+def test_graphql_deep_templates(monkeypatch):
+    monkeypatch.setitem(OBJECTS, "t3", nested("templates/backend/java", "java"))
+    monkeypatch.setitem(OBJECTS, "java", tree("{{cookiecutter.name}}")["entries"][0]["object"])
+    cli = FakeCli()
+
+    # Same templates the REST engine finds walking the whole tree
+    templates = gs._templates(cli, {"t3"})
+    assert [t.template_path for t in templates["t3"]] == ["templates/backend/java"]
+
+
+def test_graphql_partial_scans_not_indexed(monkeypatch):
+    monkeypatch.setitem(OBJECTS, "t3", nested("templates/backend/java", "java"))
+    cli = FakeCli()
+
+    # The subtree of java can't be requested, so t3 isn't scanned whole
+    assert gs._templates(cli, {"t3"}) == {"t3": []}
+    assert ti.get_index().get("t3", cli.cw_repo) is None
+
+    monkeypatch.setitem(OBJECTS, "java", tree("{{cookiecutter.name}}")["entries"][0]["object"])
+    gs._templates(cli, {"t3"})
+    assert ti.get_index().get("t3", cli.cw_repo)[0].template_path == "templates/backend/java"
+
+
+class HistoryCli(FakeCli):
+    """Serves histories of the commits, length by commit oid, a page at a time"""
+
+    lengths = {"c1": 250, "c2": 2}
+    history_pattern = re.compile(r'(\w+): object\(oid: "(\w+)"\) .*? history\(first: (\d+)(?:, after: "(\d+)")?')
+
+    def graphql(self, query, variables=None):
+        self.queries += 1
+
+        results = {}
+        for alias, oid, first, after in self.history_pattern.findall(query):
+            start = int(after or 0)
+            end = min(start + int(first), self.lengths[oid])
+            results[alias] = {"history": {
+                "nodes": [{"oid": f"{oid}-{n}", "message": "Commit"} for n in range(start, end)],
+                "pageInfo": {"hasNextPage": end < self.lengths[oid], "endCursor": str(end)},
+            }}
+
+        return {"repository": results}
+
+
+def test_graphql_histories_paginated():
+    cli = HistoryCli()
+    java = comm.Template("java", cli.cw_repo, "java")
+    inspections = [({"sha": "c1"}, java), ({"sha": "c2"}, java)]
+
+    # Every commit, as the REST engine returns, the short history is done in the first query
+    histories = gs._histories(cli, inspections, -1)
+    assert [len(history) for history in histories] == [250, 2]
+    assert histories[0][-1]["sha"] == "c1-249"
+    assert cli.queries == 3
+
+    cli.queries = 0
+    assert [len(history) for history in gs._histories(cli, inspections, 120)] == [120, 2]
+    assert cli.queries == 2
@@ -0,0 +1,104 @@
+"""Search over the local mirror of archctl.mirror"""
+import json
+import subprocess
+
+import pytest
+
+import archctl.commons as comm
+import archctl.main as main
+import archctl.mirror as mirror
+import archctl.utils as utils
+
+
+def git(path, *args):
+    return subprocess.run(
+        ["git", "-C", str(path), *args], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def commit(path, file, message):
+    file = path / file
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_text(message)
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", message)
+
+
+class Remote:
+    """The controller the mirror delegates to, no request is expected"""
+
+    cw_repo = None
+
+    def __getattr__(self, name):
+        raise AssertionError(f"Unexpected call to the remote {name}")
+
+
+@pytest.fixture
+def origin(tmp_path, monkeypatch):
+    monkeypatch.setenv("GIT_AUTHOR_NAME", "archctl")
+    monkeypatch.setenv("GIT_AUTHOR_EMAIL", "archctl@example.com")
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "archctl")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "archctl@example.com")
+    mirror._synced.clear()
+
+    path = tmp_path / "origin"
+    git(tmp_path, "init", "-q", "-b", "main", str(path))
+    commit(path, "java/{{cookiecutter.name}}/pom.xml", "Add java")
+    commit(path, "python/{{cookiecutter.name}}/setup.py", "Add python")
+    git(path, "tag", "-a", "v1", "-m", "v1")
+    commit(path, "java/{{cookiecutter.name}}/Main.java", "Java main")
+    git(path, "checkout", "-q", "-b", "develop")
+    commit(path, "python/{{cookiecutter.name}}/main.py", "Python main")
+
+    return path
+
+
+def test_mirror_reads(origin):
+    cli = mirror.GitMirror(Remote())
+    cli.cw_repo = comm.Repo("archctl", "test", "archctl/test", str(origin), None, None)
+
+    assert cli.get_default_branch() == "develop"
+    assert [b["name"] for b in cli.list_branches()] == ["develop", "main"]
+    assert cli.branch_exists("main") and not cli.branch_exists("feature")
+
+    # Annotated tags are peeled to their commit
+    tag = next(cli.list_tags())
+    assert tag["name"] == "v1"
+    assert tag["commit"]["sha"] == git(origin, "rev-parse", "v1^{commit}")
+
+    commits = [c["commit"]["message"].strip() for c in cli.get_commits("java", "main")]
+    assert commits == ["Java main", "Add java"]
+
+    info = cli.get_branch_info("main")
+    assert info["commit"]["commit"]["tree"]["sha"] == cli.get_tree_sha("main")
+
+    templates = utils.search_templates(cli, tag["commit"]["sha"])
+    assert [t.template_path for t in templates] == ["java", "python"]
+
+
+def test_mirror_fetches_new_commits(origin):
+    repo = comm.Repo("archctl", "test", "archctl/test", str(origin), None, None)
+    cli = mirror.GitMirror(Remote())
+    cli.cw_repo = repo
+    assert len(list(cli.get_commits("python", "develop"))) == 2
+
+    commit(origin, "python/{{cookiecutter.name}}/README.md", "Python readme")
+
+    # Fetched once per process
+    cli.cw_repo = repo
+    assert len(list(cli.get_commits("python", "develop"))) == 2
+
+    mirror._synced.clear()
+    cli.cw_repo = repo
+    assert len(list(cli.get_commits("python", "develop"))) == 3
+
+
+def test_search_jsonl_tags(origin, monkeypatch, capsys):
+    monkeypatch.setattr(main, "get_gh_client", Remote)
+    t_repo = comm.Repo("archctl", "test", "archctl/test", str(origin), None, None)
+
+    main.search(t_repo, 3, True, local_mirror=True, output="jsonl")
+
+    # Same as the text output, only the tags
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(r["template"], r["type"], r["ref"]) for r in records] == [("java", "tag", "v1"), ("python", "tag", "v1")]
@@ -0,0 +1,64 @@
+"""Rate limit aware scheduling of GitHub API requests"""
+import time
+
+import pytest
+
+import archctl.ratelimit as rl
+from archctl.github import Response
+
+
+def limited(text="", **headers):
+    return Response(403, headers, text)
+
+
+def ok(remaining=4999):
+    return Response(200, {"x-ratelimit-remaining": str(remaining), "x-ratelimit-reset": "0"}, "{}")
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(rl, "BACKOFF", 0.01)
+
+
+def test_budget_from_headers():
+    scheduler = rl.Scheduler()
+
+    scheduler.send(lambda: ok(1234))
+
+    assert scheduler.budget() == (1234, 0)
+
+
+def test_secondary_limit_retried():
+    scheduler = rl.Scheduler()
+    responses = [limited("You have exceeded a secondary rate limit"), ok()]
+
+    assert scheduler.send(lambda: responses.pop(0)).status == 200
+    assert scheduler.concurrency == rl.MAX_CONCURRENCY // 2
+
+
+def test_retry_after_respected():
+    scheduler = rl.Scheduler()
+    responses = [limited(**{"retry-after": "1"}), ok()]
+
+    start = time.monotonic()
+    scheduler.send(lambda: responses.pop(0))
+
+    assert time.monotonic() - start >= 1
+
+
+def test_primary_limit_exhausted():
+    scheduler = rl.Scheduler(max_wait=60)
+    reset = str(int(time.time()) + 3600)
+
+    with pytest.raises(rl.RateLimitExceeded):
+        scheduler.send(lambda: limited(**{"x-ratelimit-remaining": "0", "x-ratelimit-reset": reset}))
+
+    # Requests fail fast instead of waiting an hour for the reset
+    with pytest.raises(rl.RateLimitExceeded):
+        scheduler.acquire()
+
+
+def test_forbidden_not_retried():
+    scheduler = rl.Scheduler()
+
+    assert scheduler.send(lambda: limited("Resource not accessible")).status == 403
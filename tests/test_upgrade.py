@@ -0,0 +1,248 @@
+"""Upgrade engine of archctl.upgrade, against local git repos"""
+import shutil
+
+import pytest
+
+import archctl.commons as comm
+import archctl.git_utils as gu
+import archctl.main as main
+import archctl.render_cache as rcache
+import archctl.repo_cache as rc
+import archctl.template_cache as tc
+import archctl.upgrade as upgrader
+from tests.conftest import FakeCli, commit_files, git, local_repo, template
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_upgrade_concurrently(env, pipeline):
+    t = template(env, {"setup.cfg": "[metadata]\n", "src/app.cfg": "[app]\n"})
+    repos = [
+        local_repo(env, "svc-a", {"README.md": "old\n"}),
+        local_repo(env, "svc-b", {
+            "cookiecutter.yaml": "default_context:\n  owner: team-b\n",
+            ".archignore": "*.cfg\n",
+        }),
+        comm.Repo("archctl", "missing", "archctl/missing", str(env / "missing.git"), None, None),
+        local_repo(env, "svc-c", {"README.md": "old\n"}),
+    ]
+
+    results = upgrader.run(repos, t, yes=True, jobs=3, pipeline=pipeline)
+
+    assert [(r.repo, r.status) for r in results] == [
+        ("archctl/svc-a", "upgraded"),
+        ("archctl/svc-b", "upgraded"),
+        ("archctl/missing", "failed"),
+        ("archctl/svc-c", "upgraded"),
+    ]
+
+    readme = git(env / "svc-b.git", "show", f"{upgrader.RENDER_BRANCH}:README.md")
+    assert readme == "# service by team-b"
+
+    # The cookies stay in the repo
+    git(env / "svc-b.git", "show", f"{upgrader.RENDER_BRANCH}:cookiecutter.yaml")
+
+    # The files matched by .archignore aren't upgraded, only in the repos having it
+    assert git(env / "svc-b.git", "ls-tree", "-r", "--name-only", upgrader.RENDER_BRANCH).split() == [
+        ".archignore", "README.md", "cookiecutter.yaml", "src/app.py",
+    ]
+    assert git(env / "svc-a.git", "show", f"{upgrader.RENDER_BRANCH}:src/app.cfg") == "[app]"
+
+    assert git(env / "svc-a.git", "show", "main:README.md") == "old"
+    assert git(env / "svc-a.git", "show", f"{upgrader.RENDER_BRANCH}:README.md") == "# service by nobody"
+
+
+@pytest.mark.parametrize("strategy", ["full", "shallow", "blobless", "sparse"])
+def test_upgrade_clone_strategies(env, strategy):
+    t = template(env)
+    repo = local_repo(env, "svc", {"README.md": "old\n", "docs/index.md": "docs\n"})
+    git(env / "svc.git", "config", "uploadpack.allowFilter", "true")
+    repo.ssh_url = f"file://{repo.ssh_url}"
+
+    clone = gu.clone_repo(repo, env / "clone", strategy, "main")
+    assert git(clone.working_dir, "rev-parse", "--is-shallow-repository") == str(strategy == "shallow").lower()
+    assert (env / "clone" / "docs").exists() == (strategy != "sparse")
+
+    results = upgrader.run([repo], t, yes=True, strategy=strategy)
+
+    assert results[0].status == "upgraded"
+    assert git(env / "svc.git", "show", f"{upgrader.RENDER_BRANCH}:README.md") == "# service by nobody"
+    assert git(env / "svc.git", "show", f"{upgrader.RENDER_BRANCH}:docs/index.md") == "docs"
+    assert git(env / "svc.git", "show", f"{upgrader.RENDER_BRANCH}:src/app.py") == "print('service')"
+
+
+@pytest.mark.parametrize("strategy", ["shallow", "sparse"])
+def test_create_clone_strategies(env, monkeypatch, strategy):
+    class CreateCli(FakeCli):
+        def create_repo(self, description):
+            return True
+
+    t = template(env)
+    repo = local_repo(env, "svc", {"README.md": "new\n"})
+    git(env / "svc.git", "config", "uploadpack.allowFilter", "true")
+    repo.ssh_url = f"file://{repo.ssh_url}"
+
+    monkeypatch.setattr(main, "get_gh_client", CreateCli)
+    monkeypatch.setattr(main, "TMP_DIR", f"{env}/tmp/")
+    # A failed creation deletes the repo
+    run = main.subprocess.run
+    monkeypatch.setattr(main.subprocess, "run", lambda cmd, **kw: pytest.fail("Deleted") if cmd[0] == "gh" else run(cmd, **kw))
+
+    main.create(repo, t, yes=True, clone_strategy=strategy)
+
+    assert git(env / "svc.git", "show", "main:service/src/app.py") == "print('service')"
+
+
+def test_upgrade_from_mirror(env, monkeypatch):
+    monkeypatch.setattr(rc.RepoCache, "is_registered", lambda self, repo: True)
+    t = template(env)
+    repos = [local_repo(env, "svc-a", {"README.md": "old\n"}), local_repo(env, "svc-b", {"README.md": "b\n"})]
+
+    assert [r.status for r in upgrader.run(repos, t, yes=True, strategy="mirror")] == ["upgraded"] * 2
+
+    # Later runs fetch the new commits into the mirrors, whatever the last run left there
+    work = env / "work" / "svc-a"
+    commit_files(work, {"CHANGELOG.md": "v2\n"}, "Release v2")
+    git(work, "push", "-q", str(env / "svc-a.git"), "main")
+    git(env / "svc-a.git", "branch", "-D", upgrader.RENDER_BRANCH)
+
+    rc.get_repo_cache.cache_clear()
+    assert upgrader.run(repos[:1], t, yes=True, strategy="mirror")[0].status == "upgraded"
+    assert git(env / "svc-a.git", "show", f"{upgrader.RENDER_BRANCH}:CHANGELOG.md") == "v2"
+
+    # Their sizes are recorded once fetched, not measured for every worktree
+    cache = rc.get_repo_cache()
+    assert int(comm.cache_stamp(cache.path / "archctl" / "svc-a.git").read_text()) > 0
+    measured = []
+    dir_size = comm.dir_size
+    monkeypatch.setattr(comm, "dir_size", lambda path: measured.append(path) or dir_size(path))
+    cache.worktree(repos[0], "main", env / "worktree-a")
+    assert measured == []
+
+    # The mirrors used by this run are kept even when they don't fit
+    cache.max_size = 1
+    cache.worktree(repos[1], "main", env / "worktree-b")
+    assert sorted(p.name for p in (cache.path / "archctl").iterdir() if p.is_dir()) == ["svc-a.git", "svc-b.git"]
+
+    # Later runs evict them, all but the ones in use
+    shutil.rmtree(env / "worktree-b")
+    rc.get_repo_cache.cache_clear()
+    cache = rc.get_repo_cache()
+    cache.max_size = 1
+    cache.worktree(repos[1], "main", env / "worktree")
+    assert [p.name for p in (cache.path / "archctl").iterdir() if p.is_dir()] == ["svc-b.git"]
+
+
+def test_template_checkout_cache(env, monkeypatch):
+    t = template(env)
+    work = env / "work" / "templates"
+    git(work, "tag", "-a", "v1", "-m", "v1")
+    git(work, "push", "-q", "--tags", str(env / "templates.git"))
+
+    clones = []
+    clone_from = tc.Repo.clone_from
+    monkeypatch.setattr(tc.Repo, "clone_from", lambda url, *args, **kw: clones.append(url) or clone_from(url, *args, **kw))
+
+    checkout = tc.get_template_dir(t)
+    assert checkout.name == git(work, "rev-parse", "main")
+    assert (checkout / "python" / "cookiecutter.json").exists()
+
+    # Every ref pointing to the same commit shares the checkout
+    assert tc.get_template_dir(comm.TemplateVersion(t.template, "v1")) == checkout
+    assert upgrader.run([local_repo(env, "svc", {"README.md": "old\n"})], t, yes=True)[0].status == "upgraded"
+    assert clones.count(t.template.template_repo.ssh_url) == 1
+
+    # So does the SHA of the commit, without asking the remote
+    resolve_ref = tc.resolve_ref
+    monkeypatch.setattr(tc, "resolve_ref", lambda url, ref=None: pytest.fail("SHA resolved"))
+    assert tc.get_template_dir(comm.TemplateVersion(t.template, checkout.name)) == checkout
+    assert clones.count(t.template.template_repo.ssh_url) == 1
+    monkeypatch.setattr(tc, "resolve_ref", resolve_ref)
+
+    commit_files(work, {"python/{{cookiecutter.name}}/NEW.md": "new\n"}, "New file")
+    git(work, "push", "-q", str(env / "templates.git"), "main")
+
+    assert tc.get_template_dir(t).name == git(work, "rev-parse", "main")
+    assert clones.count(t.template.template_repo.ssh_url) == 2
+
+    # Later runs evict the checkouts that don't fit
+    monkeypatch.setattr(tc, "MAX_SIZE_MB", 0)
+    tc._used.clear()
+    commit_files(work, {"python/{{cookiecutter.name}}/NEWER.md": "newer\n"}, "Newer file")
+    git(work, "push", "-q", str(env / "templates.git"), "main")
+
+    checkout = tc.get_template_dir(t)
+    assert [p.name for p in checkout.parent.iterdir() if p.is_dir()] == [checkout.name]
+
+
+def test_render_once_per_cookies(env, monkeypatch):
+    renders = []
+    cc = upgrader.cc
+    monkeypatch.setattr(upgrader, "cc", lambda **kw: renders.append(kw) or cc(**kw))
+
+    t = template(env)
+    team_b = "default_context:\n  owner: team-b\n"
+    repos = [
+        local_repo(env, "svc-a", {"cookiecutter.yaml": team_b}),
+        local_repo(env, "svc-b", {"cookiecutter.yaml": "# Same cookies\n" + team_b}),
+        local_repo(env, "svc-c", {"README.md": "old\n"}),
+    ]
+
+    assert [r.status for r in upgrader.run(repos, t, yes=True)] == ["upgraded"] * 3
+    assert len(renders) == 2
+
+    readmes = [git(env / f"{r.repo}.git", "show", f"{upgrader.RENDER_BRANCH}:README.md") for r in repos]
+    assert readmes == ["# service by team-b", "# service by team-b", "# service by nobody"]
+
+    # The renders are left intact for the next repos
+    for r in repos:
+        git(env / f"{r.repo}.git", "branch", "-D", upgrader.RENDER_BRANCH)
+    assert [r.status for r in upgrader.run(repos, t, yes=True)] == ["upgraded"] * 3
+    assert len(renders) == 2
+    assert git(env / "svc-c.git", "show", f"{upgrader.RENDER_BRANCH}:src/app.py") == "print('service')"
+
+
+def test_render_cache_evicted(monkeypatch):
+    def render(text):
+        return lambda output_dir: (output_dir / "project").mkdir() or (output_dir / "project" / "f").write_text(text)
+
+    # Room for two one byte renders
+    monkeypatch.setattr(rcache, "MAX_SIZE_MB", 2 / 1024 / 1024)
+    a = rcache.get_render("a", render("a"))
+    b = rcache.get_render("b", render("b"))
+    c = rcache.get_render("c", render("c"))
+
+    # The renders used by the process are kept
+    assert a.exists() and b.exists() and c.exists()
+
+    # The least recently used one is evicted by later runs
+    rcache._used.clear()
+    assert rcache.get_render("a", render("a")) == a
+    rcache._used.clear()
+    d = rcache.get_render("d", render("d"))
+
+    assert sorted(p.name for p in (comm.CACHE_DIR / "renders").iterdir()) == ["a", "a.used", "d", "d.used"]
+    assert (d / "f").read_text() == "d"
+
+
+def test_upgrade_up_to_date(env):
+    t = template(env)
+    repo = local_repo(env, "svc", {"README.md": "old\n"})
+
+    assert upgrader.run([repo], t, yes=True)[0].status == "upgraded"
+
+    # Merge the upgrade, nothing is left to upgrade then
+    origin = env / "svc.git"
+    git(origin, "update-ref", "refs/heads/main", f"refs/heads/{upgrader.RENDER_BRANCH}")
+    git(origin, "branch", "-D", upgrader.RENDER_BRANCH)
+
+    assert upgrader.run([repo], t, yes=True)[0].status == "up to date"
+    assert git(origin, "branch", "--list", upgrader.RENDER_BRANCH) == ""
+
+
+def test_upgrade_pr_failed(env, monkeypatch):
+    # The env fixture makes the controller a FakeCli
+    monkeypatch.setattr(upgrader.get_gh_client, "create_pr", lambda self, head, base, title="": False)
+    t = template(env)
+
+    result = upgrader.run([local_repo(env, "svc", {"README.md": "old\n"})], t, yes=True)[0]
+    assert (result.status, result.detail) == ("failed", "open_pr: Could not create the PR")
@@ -0,0 +1,268 @@
+"""Search helpers of archctl.utils"""
+import random
+import time
+from functools import partial
+
+import archctl.commons as comm
+import archctl.search_cache as sc
+import archctl.template_index as ti
+import archctl.utils as utils
+
+REPO = comm.Repo("archctl", "test", "archctl/test", None, None, None)
+
+
+class TreeCli:
+    """Serves the trees of a template monorepo, counting the downloads"""
+
+    cw_repo = REPO
+
+    def __init__(self, trees, refs):
+        self.trees = trees
+        self.refs = refs
+        self.downloads = 0
+
+    def get_tree_sha(self, ref=None):
+        return self.refs[ref or "main"]
+
+    def get_tree(self, ref=None, recursive="0"):
+        self.downloads += 1
+        return {"sha": ref, "tree": self.trees[ref], "truncated": False}
+
+
+class MonorepoCli:
+    """Serves the trees of the given dirs by SHA, truncating the recursive
+    ones bigger than limit like GitHub does"""
+
+    cw_repo = REPO
+
+    def __init__(self, dirs, limit):
+        self.limit = limit
+        self.trees = {}
+        self.fetched = []
+        self.root = self.__build("", dirs)
+
+    def __build(self, prefix, dirs):
+        children = sorted({d[len(prefix):].split("/")[0] for d in dirs if d.startswith(prefix)})
+        entries = [
+            {"path": c, "mode": "040000", "sha": self.__build(f"{prefix}{c}/", dirs)}
+            for c in children
+        ]
+        entries.append({"path": "README.md", "mode": "100644", "sha": "blob"})
+        sha = f"tree:{prefix}"
+        self.trees[sha] = entries
+        return sha
+
+    def __recursive(self, sha, prefix=""):
+        for entry in self.trees[sha]:
+            yield {**entry, "path": f"{prefix}{entry['path']}"}
+            if entry["mode"] == "040000":
+                yield from self.__recursive(entry["sha"], f"{prefix}{entry['path']}/")
+
+    def get_tree_sha(self, ref=None):
+        return self.root
+
+    def get_tree(self, ref=None, recursive="0"):
+        self.fetched.append((ref, recursive))
+        if recursive == "0":
+            return {"sha": ref, "tree": self.trees[ref], "truncated": False}
+
+        entries = list(self.__recursive(ref))
+        return {"sha": ref, "tree": entries[:self.limit], "truncated": len(entries) > self.limit}
+
+
+def cc_tree(*templates):
+    entries = []
+    for t in templates:
+        entries += [
+            {"path": t, "mode": "040000"},
+            {"path": f"{t}/{{{{cookiecutter.name}}}}", "mode": "040000"},
+            {"path": f"{t}/{{{{cookiecutter.name}}}}/src", "mode": "040000"},
+        ]
+    return entries
+
+
+def inspect(kind, template, ref):
+    """Fake inspection that takes a random time to complete"""
+    time.sleep(random.uniform(0, 0.02))
+
+    if kind == "tags":
+        return {template: {"tags": [ref]}}
+
+    return {template: {"branches": {ref: [{"message": ref, "sha": ref}]}}}
+
+
+def test_run_inspections_deterministic():
+    inspections = [partial(inspect, "tags", t, f"v{i}") for i in range(5) for t in "ab"]
+    inspections += [partial(inspect, "branches", t, f"b{i}") for i in range(5) for t in "ba"]
+
+    sequential = {}
+    for resul in utils.run_inspections(inspections):
+        sequential = utils.merge_search(sequential, resul)
+
+    concurrent = {}
+    for resul in utils.run_inspections(inspections, jobs=8):
+        concurrent = utils.merge_search(concurrent, resul)
+
+    assert list(concurrent) == ["a", "b"]
+    assert repr(concurrent) == repr(sequential)
+
+
+def test_iter_inspections_order():
+    def inspection(i):
+        time.sleep(0.05 if i == 0 else 0)
+        return i
+
+    inspections = [partial(inspection, i) for i in range(20)]
+
+    assert list(utils.iter_inspections(inspections, jobs=4)) == list(range(20))
+
+    # The slow first inspection doesn't hold back the others
+    completion = list(utils.iter_inspections(inspections, jobs=4, stable=False))
+    assert sorted(completion) == list(range(20))
+    assert completion[0] != 0
+
+
+def test_search_records():
+    resul = {"java": {"tags": ["v1"], "branches": {"main": [{"message": "Init", "sha": "c1"}]}}}
+
+    assert list(utils.search_records(resul)) == [
+        {"template": "java", "type": "tag", "ref": "v1"},
+        {"template": "java", "type": "commit", "ref": "main", "message": "Init", "sha": "c1"},
+    ]
+
+
+def test_search_templates_indexed_by_tree():
+    trees = {"t1": cc_tree("java", "python"), "t2": cc_tree("java")}
+    refs = {"main": "t1", "v1": "t1", "v2": "t1", "develop": "t2"}
+    cli = TreeCli(trees, refs)
+
+    for ref in refs:
+        utils.search_templates(cli, ref)
+
+    assert cli.downloads == 2
+    assert [t.template for t in utils.search_templates(cli, "v2")] == ["java", "python"]
+
+    # The index survives the process
+    ti.get_index().save()
+    ti.get_index.cache_clear()
+    cli = TreeCli(trees, refs)
+
+    assert [t.template_path for t in utils.search_templates(cli, "develop")] == ["java"]
+    assert cli.downloads == 0
+
+
+def test_find_templates_matches_naive_filter():
+    names = ["a", "b", "{{cookiecutter.x}}", "{{cookiecutter.y}}", "c}}", "{{cookiecutter"]
+    rng = random.Random(0)
+    paths = list({
+        "/".join(rng.choice(names) for _ in range(rng.randint(1, 5))) for _ in range(2000)
+    })
+
+    for path in paths:
+        assert utils.is_cookiecutter_dir(path) == bool(utils.cookiecutter_dir_pattern.match(path))
+
+    cc_dirs = [p for p in paths if utils.cookiecutter_dir_pattern.match(p)]
+    naive = [
+        p for p in cc_dirs
+        if not any(o != p and o.split("/") == p.split("/")[:len(o.split("/"))] for o in cc_dirs)
+    ]
+
+    assert utils.top_level_paths(cc_dirs) == naive
+
+
+def test_search_templates_truncated_tree():
+    dirs = [f"group{g}/t{i}/{{{{cookiecutter.name}}}}/src/{{{{cookiecutter.pkg}}}}" for g in range(3) for i in range(4)]
+    dirs += [f"docs/section{i}/page{j}" for i in range(5) for j in range(5)]
+    expected = sorted(f"group{g}/t{i}" for g in range(3) for i in range(4))
+
+    small = MonorepoCli(dirs, limit=10**6)
+    assert sorted(t.template_path for t in utils.search_templates(small, "main")) == expected
+    assert small.fetched == [(small.root, "1")]
+
+    ti.get_index.cache_clear()
+    truncated = MonorepoCli(dirs, limit=20)
+    assert sorted(t.template_path for t in utils.search_templates(truncated, "main")) == expected
+
+    # The subtrees of the cookiecutter dirs are never requested
+    assert not any("{{cookiecutter.name}}/" in sha for sha, _ in truncated.fetched)
+
+
+def test_failed_walks_not_indexed():
+    dirs = [f"group{g}/t{i}/{{{{cookiecutter.name}}}}" for g in range(3) for i in range(4)]
+    cli = MonorepoCli(dirs, limit=10)
+    get_tree = cli.get_tree
+
+    # The subtree of group1 can't be fetched, so the tree isn't walked whole
+    cli.get_tree = lambda ref=None, recursive="0": {} if ref == "tree:group1/" else get_tree(ref, recursive)
+    assert utils.search_templates(cli, "main") == []
+    assert ti.get_index().get(cli.root, REPO) is None
+
+    # Nor can the root tree
+    cli.get_tree = lambda ref=None, recursive="0": {}
+    assert utils.tree_templates(cli, cli.root) == []
+    assert ti.get_index().get(cli.root, REPO) is None
+
+    # Once the API recovers the tree is walked and indexed
+    cli.get_tree = get_tree
+    assert len(utils.search_templates(cli, "main")) == 12
+    assert len(ti.get_index().get(cli.root, REPO)) == 12
+
+
+class HistoryCli:
+    """Serves the history of a single template, counting the commits fetched"""
+
+    cw_repo = REPO
+
+    def __init__(self, history):
+        self.history = history
+        self.fetched = 0
+
+    def get_commits(self, path=None, sha=None, per_page=100):
+        for commit in self.history[self.history.index(sha):]:
+            self.fetched += 1
+            yield {"sha": commit, "commit": {"message": f"Commit {commit}"}}
+
+
+def test_incremental_search():
+    template = comm.Template("java", REPO, "java")
+    watermarks = sc.get_watermarks(REPO.full_name)
+    cli = HistoryCli([f"c{i}" for i in range(10, 0, -1)])
+
+    def search(head, depth):
+        resul = utils.inspect_branch({}, cli, "main", depth, template, head, watermarks)
+        return [c["sha"] for c in resul["java"]["branches"]["main"]]
+
+    assert search("c10", -1) == cli.history
+    assert cli.fetched == 10
+
+    # Nothing is fetched while the head doesn't move
+    assert search("c10", 3) == ["c10", "c9", "c8"]
+    assert cli.fetched == 10
+
+    # Only the new commits, up to the first known one
+    cli.history[:0] = ["c12", "c11"]
+    assert search("c12", -1) == cli.history
+    assert cli.fetched == 13
+
+    # The watermarks survive the process
+    watermarks.save()
+    sc.get_watermarks.cache_clear()
+    watermarks = sc.get_watermarks(REPO.full_name)
+    assert search("c12", -1) == cli.history
+    assert cli.fetched == 13
+
+
+def test_resolve_templates_per_tree():
+    trees = {"t1": cc_tree("java", "python"), "t2": cc_tree("java")}
+    refs = {f"v{i}": "t1" if i % 2 else "t2" for i in range(20)}
+    cli = TreeCli(trees, refs)
+    cli.resolved = []
+    get_tree_sha = cli.get_tree_sha
+    cli.get_tree_sha = lambda ref=None: cli.resolved.append(ref) or get_tree_sha(ref)
+
+    templates = utils.resolve_templates(cli, list(refs) + ["v1", "v2"], jobs=4)
+
+    assert [t.template for t in templates["v1"]] == ["java", "python"]
+    assert [t.template for t in templates["v2"]] == ["java"]
+    assert sorted(cli.resolved) == sorted(refs)
+    assert cli.downloads == 2